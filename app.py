@@ -1,28 +1,35 @@
+import time
+_import_started_at = time.perf_counter()
 import os
+import sys
+import errno
 import zipfile
 import tarfile
-import py7zr
-import time
 import shutil
 import string
 import random
 import re
 import threading
 import hashlib
+import hmac
 import base64
-from flask import Flask, request, jsonify, render_template, send_file
-from pymongo import MongoClient
+import json
+import zlib
+import queue
+import importlib.util
+import socket
+from collections import deque, OrderedDict
+from flask import Flask, request, jsonify, render_template, send_file, Response
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from bson import ObjectId
 from datetime import datetime, timedelta
 import logging
 from werkzeug.utils import secure_filename
 from gridfs import GridFS
 from urllib.parse import quote
-import qrcode
 import io
 import secrets
-import smtplib
-from email.message import EmailMessage
 from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
@@ -45,24 +52,271 @@ MAX_CONCURRENT_TASKS = int(os.environ.get('MAX_CONCURRENT_TASKS', 3))
 executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TASKS)
 active_task_count = 0
 task_lock = threading.Lock()
+SHARE_COALESCE_WINDOW_SECONDS = 30 * 60  # 超過此時間仍在「處理中」的分享任務視為卡住，不再併入
+SHARE_CLAIM_ATTEMPTS = 3
+
+# --- 檢查點與中斷續跑 ---
+CHECKPOINT_INTERVAL_LAYERS = int(os.environ.get('CHECKPOINT_INTERVAL_LAYERS', 5))  # 每幾層存一次檢查點，0 為停用
+TASK_HEARTBEAT_SECONDS = 60
+TASK_STALE_SECONDS = int(os.environ.get('TASK_STALE_SECONDS', 300))  # 超過此時間沒有心跳的任務視為所屬程序已中止
+MAX_TASK_RESUMES = 3
+worker_token = None  # 見 worker_id()
+worker_token_pid = None
+
+# --- 暫存空間預留與清理 ---
+TEMP_SPACE_MARGIN_BYTES = int(os.environ.get('TEMP_SPACE_MARGIN_MB', 256)) * 1024 * 1024  # 永遠保留給系統的空間
+TEMP_SPACE_WAIT_SECONDS = 10 * 60  # 排隊等待空間的上限，超過即判定任務失敗
+TEMP_SPACE_RETRY_SECONDS = 5  # 空間不足時隔多久重新排入佇列
+TEMP_SWEEP_INTERVAL_SECONDS = int(os.environ.get('TEMP_SWEEP_INTERVAL_SECONDS', 600))
+TEMP_SWEEP_GRACE_SECONDS = 5 * 60  # 剛寫入的檔案不清理，避免與正在收尾的任務搶刪
+ORPHAN_FILE_MAX_AGE_SECONDS = 24 * 3600  # 無法對應到任務的檔案，超過此時間才清理
+TERMINAL_STATUSES = ['完成', '失敗', '已取消', '已刪除', '已刪除 (管理員清除)']
+TASK_FILE_PATTERN = re.compile(r'^([0-9a-f]{24})_')
+reserved_temp_bytes = 0
+temp_space_lock = threading.Lock()
+last_temp_sweep_at = 0
+
+# --- 進度串流 ---
+PROGRESS_STREAM_POLL_SECONDS = 1
+PROGRESS_STREAM_MAX_SECONDS = 30 * 60  # gevent 模式的連線上限，逾時後由前端重新連線
+# 同步 worker 在一個請求超過 gunicorn --timeout（Dockerfile 預設 120 秒）時會被 arbiter 砍掉，
+# 執行中的壓縮執行緒也會一起消失，所以串流必須在那之前結束，交給 EventSource 自動重連
+PROGRESS_STREAM_SYNC_MAX_SECONDS = 60
+PROGRESS_STREAM_RETRY_MS = 1000
+
+# --- QR Code 快取 ---
+QR_CACHE_SIZE = int(os.environ.get('QR_CACHE_SIZE', 256))  # 最多快取幾張 QR Code（依分享網址 + 尺寸 + 格式）
+QR_DEFAULT_BOX_SIZE = 10
+QR_MIN_BOX_SIZE, QR_MAX_BOX_SIZE = 2, 20
+QR_CACHE_MAX_AGE_SECONDS = 30 * 24 * 3600  # 內容只由分享網址決定，同一網址永遠產生同一張圖
+QR_FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml'}
+qr_cache = OrderedDict()
+qr_cache_lock = threading.Lock()
 
 # --- 檔案驗證設定 ---
-ALLOWED_EXTENSIONS = {'.zip', '.7z', '.gz', '.bz2', '.xz', '.tar'}
+ALLOWED_EXTENSIONS = {'.zip', '.7z', '.gz', '.bz2', '.xz', '.tar', '.zst', '.lz4'}
+# 壓縮層格式 → 副檔名；tarzst / tarlz4 需要選用套件 zstandard / lz4
+LAYER_FORMATS = {'zip': '.zip', '7z': '.7z', 'targz': '.tar.gz', 'tarzst': '.tar.zst', 'tarlz4': '.tar.lz4'}
+LAYER_FORMAT_MODULES = {'tarzst': 'zstandard', 'tarlz4': 'lz4'}
 MAX_FILE_SIZE_MB = int(os.environ.get('MAX_FILE_SIZE_MB', 100))
 MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
 MAX_DECOMPRESS_SIZE_BYTES = 1 * 1024 * 1024 * 1024 # 1 GB
 
-client = None; db = None; tasks_collection = None; fs = None
-try:
-    if not MONGO_URI: raise ValueError("錯誤：找不到 MONGO_URI 環境變數。")
-    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-    client.admin.command('ping')
-    logging.info("✅ 成功連線至 MongoDB！")
-    db = client['compressor_db']
-    tasks_collection = db['tasks']
-    fs = GridFS(db)
-except Exception as e:
-    logging.error(f"❌ 應用程式啟動失敗: {e}")
+# --- 結果檔案儲存 ---
+# 壓縮 / 解壓縮結果與檢查點都透過 storage 存取。gridfs 為預設；
+# local 存在本機或共享檔案系統（NFS 等），下載時可支援 Range 並交由 gunicorn 以 sendfile 零複製傳送。
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'gridfs')
+STORAGE_PATH = os.environ.get('STORAGE_PATH', '/tmp/compressor_results')
+STORAGE_QUOTA_MB = int(os.environ.get('STORAGE_QUOTA_MB', 0))  # 0 表示使用各儲存方式的預設容量
+GRIDFS_DEFAULT_QUOTA_BYTES = 512 * 1024 * 1024  # MongoDB Atlas 免費版上限
+
+class GridFSStorage:
+    name = 'gridfs'
+    def __init__(self, database):
+        self.db = database
+        self.fs = GridFS(database)
+    @staticmethod
+    def owns(file_id):
+        return ObjectId.is_valid(file_id)
+    def put_file(self, path, filename, move=False):
+        with open(path, 'rb') as f_in:
+            file_id = str(self.fs.put(f_in, filename=filename))
+        if move: os.remove(path)
+        return file_id
+    def download_to(self, file_id, dest_path):
+        grid_out = self.fs.get(ObjectId(file_id))
+        with open(dest_path, 'wb') as f_out:
+            shutil.copyfileobj(grid_out, f_out, 1024 * 1024)
+    def size(self, file_id):
+        return self.fs.get(ObjectId(file_id)).length
+    def delete(self, file_id):
+        self.fs.delete(ObjectId(file_id))
+    def delete_all(self):
+        file_ids = [doc['_id'] for doc in self.db['fs.files'].find({}, {'_id': 1})]
+        for file_id in file_ids: self.fs.delete(file_id)
+        return len(file_ids)
+    def usage(self):
+        result = list(self.db['fs.files'].aggregate([{'$group': {'_id': None, 'total_size': {'$sum': '$length'}}}]))
+        return (result[0]['total_size'] if result else 0), self.db['fs.files'].count_documents({})
+    def quota_bytes(self):
+        return STORAGE_QUOTA_MB * 1024 * 1024 if STORAGE_QUOTA_MB else GRIDFS_DEFAULT_QUOTA_BYTES
+    def send(self, file_id, download_name):
+        grid_out = self.fs.get(ObjectId(file_id))
+        return send_file(grid_out, mimetype='application/octet-stream', as_attachment=True, download_name=download_name)
+
+class LocalStorage:
+    name = 'local'
+    FILE_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+    @classmethod
+    def owns(cls, file_id):
+        return bool(cls.FILE_ID_PATTERN.match(file_id))
+    def _path(self, file_id):
+        if not self.owns(file_id): raise ValueError("無效的檔案 ID。")
+        return os.path.join(self.root, file_id)
+    def put_file(self, path, filename, move=False):
+        """move=True 時來源檔交由儲存區接手：同一個檔案系統直接改名，不必再寫一次。"""
+        file_id = secrets.token_hex(16)
+        dest_path = self._path(file_id)
+        if move:
+            try:
+                os.replace(path, dest_path)
+                return file_id
+            except OSError as e:
+                if e.errno != errno.EXDEV: raise
+        # 跨檔案系統：先寫到 .part 再原子地改名，讀取端永遠不會看到寫一半的檔案；copyfile 在 Linux 上走 sendfile
+        shutil.copyfile(path, dest_path + '.part')
+        os.replace(dest_path + '.part', dest_path)
+        if move: os.remove(path)
+        return file_id
+    def download_to(self, file_id, dest_path):
+        shutil.copyfile(self._path(file_id), dest_path)
+    def size(self, file_id):
+        return os.path.getsize(self._path(file_id))
+    def delete(self, file_id):
+        path = self._path(file_id)
+        if os.path.exists(path): os.remove(path)
+    def _stored_files(self):
+        return [entry for entry in os.scandir(self.root) if entry.is_file() and self.FILE_ID_PATTERN.match(entry.name)]
+    def delete_all(self):
+        entries = self._stored_files()
+        for entry in entries: os.remove(entry.path)
+        return len(entries)
+    def usage(self):
+        entries = self._stored_files()
+        return sum(entry.stat().st_size for entry in entries), len(entries)
+    def quota_bytes(self):
+        return STORAGE_QUOTA_MB * 1024 * 1024 if STORAGE_QUOTA_MB else shutil.disk_usage(self.root).total
+    def send(self, file_id, download_name):
+        # conditional=True 讓 werkzeug 處理 Range / If-None-Match；以路徑傳送時 gunicorn 會改用 sendfile
+        return send_file(self._path(file_id), mimetype='application/octet-stream', as_attachment=True,
+                         download_name=download_name, conditional=True)
+
+class StorageRouter:
+    """切換 STORAGE_BACKEND 後，舊任務的 result_file_id 仍在原本的儲存區：依 ID 格式轉給對應的儲存方式。
+
+    GridFS 的 ID 是 24 位十六進位的 ObjectId，local 是 32 位；新檔案一律寫入 primary。
+    """
+    def __init__(self, primary, fallback):
+        self.primary = primary; self.fallback = fallback
+        self.name = primary.name
+    def _owner(self, file_id):
+        return self.fallback if self.fallback.owns(file_id) and not self.primary.owns(file_id) else self.primary
+    def put_file(self, path, filename, move=False):
+        return self.primary.put_file(path, filename, move=move)
+    def download_to(self, file_id, dest_path):
+        self._owner(file_id).download_to(file_id, dest_path)
+    def size(self, file_id):
+        return self._owner(file_id).size(file_id)
+    def delete(self, file_id):
+        self._owner(file_id).delete(file_id)
+    def delete_all(self):
+        return self.primary.delete_all() + self.fallback.delete_all()
+    def usage(self):
+        (primary_bytes, primary_count), (fallback_bytes, fallback_count) = self.primary.usage(), self.fallback.usage()
+        return primary_bytes + fallback_bytes, primary_count + fallback_count
+    def quota_bytes(self):
+        return self.primary.quota_bytes()
+    def send(self, file_id, download_name):
+        return self._owner(file_id).send(file_id, download_name)
+
+def create_storage(database):
+    if STORAGE_BACKEND == 'local':
+        return StorageRouter(LocalStorage(STORAGE_PATH), GridFSStorage(database))
+    if STORAGE_BACKEND == 'gridfs':
+        # 曾經用過 local 才需要轉送；不主動建立資料夾
+        if os.path.isdir(STORAGE_PATH): return StorageRouter(GridFSStorage(database), LocalStorage(STORAGE_PATH))
+        return GridFSStorage(database)
+    raise ValueError(f"不支援的 STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+# --- MongoDB 延遲連線 ---
+# MongoClient 建構時不做網路 I/O（mongodb+srv 例外，需解析 DNS），真正的連線由背景執行緒探測，
+# 因此 import app 與 gunicorn worker 開機都不會被慢速的資料庫拖住。
+MONGO_READY_RETRY_SECONDS = 5
+client = None; db = None; tasks_collection = None; storage = None
+mongo_lock = threading.Lock()
+mongo_ready = threading.Event()
+mongo_last_error = None
+mongo_thread_local = threading.local()
+
+def gevent_patched(module_name):
+    # async_server 會在載入 app 之前替換模組；同步 worker 下 gevent 根本不會被 import
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    return bool(gevent_monkey and gevent_monkey.is_module_patched(module_name))
+
+def connect_mongo():
+    return MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+
+def open_mongo():
+    """建立一組 client / db / tasks_collection / storage。"""
+    new_client = connect_mongo()
+    database = new_client['compressor_db']
+    return {'client': new_client, 'db': database, 'tasks_collection': database['tasks'], 'storage': create_storage(database)}
+
+def thread_mongo():
+    if getattr(mongo_thread_local, 'handles', None) is None:
+        mongo_thread_local.handles = open_mongo()
+    return mongo_thread_local.handles
+
+class ThreadMongoHandle:
+    """gevent 模式下代替 client / db / tasks_collection / storage：每個原生執行緒各自使用一組 MongoClient。
+
+    gevent socket 綁定建立它的執行緒，同一個連線池若同時被事件迴圈與 executor 執行緒取用，換手時會丟出
+    「Cannot switch to a different thread」。事件迴圈上的所有請求 greenlet 共用 hub 執行緒那一組，
+    查詢時只讓出事件迴圈；壓縮 / 解壓縮與背景維護執行緒則各用自己的，互不共用連線。
+    """
+    def __init__(self, name):
+        self._name = name
+    def __getattr__(self, attr):
+        return getattr(thread_mongo()[self._name], attr)
+    def __getitem__(self, key):
+        return thread_mongo()[self._name][key]
+
+def init_mongo():
+    """第一次需要時建立 MongoClient，並啟動背景就緒探測；重複呼叫不會有額外成本。"""
+    global client, db, tasks_collection, storage, mongo_last_error
+    if client is not None or not MONGO_URI: return
+    with mongo_lock:
+        if client is not None: return
+        try:
+            if gevent_patched('socket'):
+                thread_mongo()  # 先在目前的執行緒建立一次，設定錯誤在這裡就會被攔下
+                db, tasks_collection, storage = (ThreadMongoHandle(name) for name in ('db', 'tasks_collection', 'storage'))
+                client = ThreadMongoHandle('client')
+            else:
+                handles = open_mongo()
+                db, tasks_collection, storage = handles['db'], handles['tasks_collection'], handles['storage']
+                client = handles['client']
+        except Exception as e:
+            mongo_last_error = str(e)
+            logging.error(f"❌ 建立 MongoDB 連線失敗: {e}")
+            return
+    threading.Thread(target=probe_mongo_ready, name='task-maintenance', daemon=True).start()
+
+def probe_mongo_ready():
+    global mongo_last_error
+    while not mongo_ready.is_set():
+        try:
+            client.admin.command('ping')
+            mongo_last_error = None
+            mongo_ready.set()
+            logging.info("✅ 成功連線至 MongoDB！")
+        except Exception as e:
+            mongo_last_error = str(e)
+            logging.warning(f"⚠️ MongoDB 尚未就緒，{MONGO_READY_RETRY_SECONDS} 秒後重試: {e}")
+            time.sleep(MONGO_READY_RETRY_SECONDS)
+    # 就緒後由同一個執行緒接手背景維護，gevent 模式下不必再多建一組 MongoClient
+    maintenance_loop()
+
+if not MONGO_URI:
+    mongo_last_error = "錯誤：找不到 MONGO_URI 環境變數。"
+    logging.error(f"❌ 應用程式啟動失敗: {mongo_last_error}")
+
+@app.before_request
+def ensure_mongo():
+    init_mongo()
 
 # --- 通用輔助函式 ---
 def generate_password(length=12):
@@ -73,6 +327,13 @@ def update_task_log(task_id, message, is_progress_text=False):
     if is_progress_text:
         update_doc['$set'] = {'progress_text': message}
     tasks_collection.update_one({'_id': task_id}, update_doc)
+def worker_id():
+    # 主機名稱 + PID 在容器重啟後會原樣重現，新程序就會替舊程序的任務續命；
+    # 所以再加上每個程序自己的隨機值。gunicorn fork 後 PID 才確定，因此依 PID 產生而不是在 import 時
+    global worker_token, worker_token_pid
+    if worker_token_pid != os.getpid():
+        worker_token, worker_token_pid = secrets.token_hex(8), os.getpid()
+    return f"{socket.gethostname()}:{os.getpid()}:{worker_token}"
 def update_task_progress(task_id, progress):
     tasks_collection.update_one({'_id': task_id}, {'$set': {'progress': progress}})
 def parse_password_text(password_text):
@@ -111,58 +372,605 @@ def validate_file(file, mode='compress'):
             raise ValueError("檔案宣稱是 ZIP 檔，但內容格式不符，可能為惡意檔案。")
         if filename_lower.endswith('.7z') and not header.startswith(b"7z\xbc\xaf'\x1c"):
             raise ValueError("檔案宣稱是 7z 檔，但內容格式不符，可能為惡意檔案。")
+        if filename_lower.endswith('.zst') and not header.startswith(b'\x28\xb5\x2f\xfd'):
+            raise ValueError("檔案宣稱是 zstd 檔，但內容格式不符，可能為惡意檔案。")
+        if filename_lower.endswith('.lz4') and not header.startswith(b'\x04\x22\x4d\x18'):
+            raise ValueError("檔案宣稱是 LZ4 檔，但內容格式不符，可能為惡意檔案。")
+
+def validate_layer_formats(formats):
+    if not formats: raise ValueError("請至少指定一種壓縮格式。")
+    for format_name in formats:
+        if format_name not in LAYER_FORMATS:
+            raise ValueError(f"不支援的壓縮格式: {format_name}（可用: {', '.join(LAYER_FORMATS)}）")
+        module_name = LAYER_FORMAT_MODULES.get(format_name)
+        if module_name and importlib.util.find_spec(module_name) is None:
+            raise ValueError(f"伺服器未安裝 {module_name}，無法使用 {format_name} 格式。")
+
+# --- 平行 gzip (targz 層) ---
+# pigz 式做法：tar 串流切成固定大小的區塊，各區塊在執行緒池上獨立壓成一個 gzip member
+# （zlib 壓縮時會釋放 GIL），再依原順序寫出。多 member 的 gzip 是標準格式，tarfile / gzip 皆可直接讀取。
+GZIP_LEVEL = 9  # 與原本 tarfile 'w:gz' 的預設壓縮等級一致
+GZIP_BLOCK_SIZE = 1024 * 1024
+GZIP_THREADS = int(os.environ.get('GZIP_THREADS', os.cpu_count() or 1))
+gzip_executor = None
+gzip_executor_lock = threading.Lock()
+
+def get_gzip_executor():
+    global gzip_executor
+    with gzip_executor_lock:
+        if gzip_executor is None:
+            gzip_executor = ThreadPoolExecutor(max_workers=max(1, GZIP_THREADS), thread_name_prefix='gzip')
+    return gzip_executor
+
+def compress_gzip_member(data, level=GZIP_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+class ParallelGzipWriter:
+    """可當作 tarfile 串流模式 fileobj 的 gzip 寫入器；close() 只會寫完資料，不會關閉底層檔案。"""
+    def __init__(self, fileobj, level=GZIP_LEVEL, block_size=GZIP_BLOCK_SIZE):
+        self.fileobj = fileobj; self.level = level; self.block_size = block_size
+        self.buffer = bytearray(); self.pending = deque(); self.members = 0
+        self.pool = get_gzip_executor()
+        self.max_pending = max(1, GZIP_THREADS) * 2  # 限制尚未寫出的區塊數，避免整個檔案堆在記憶體
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(compress_gzip_member, block, self.level))
+        self.members += 1
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+    def close(self):
+        if self.buffer or not self.members:
+            self._submit(bytes(self.buffer)); self.buffer.clear()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+class ThreadedGzipReader:
+    """在背景執行緒解壓 gzip（含多 member），讓解壓與 tar 解包寫檔同時進行。"""
+    _EOF = object()
+    def __init__(self, path, chunk_size=GZIP_BLOCK_SIZE, max_chunks=8):
+        self.path = path; self.chunk_size = chunk_size
+        self.chunks = queue.Queue(maxsize=max_chunks); self.stopped = threading.Event()
+        # 目前的區塊與讀取位置；只切 memoryview，不用每次 read 都複製剩下的整個區塊
+        self.current = memoryview(b''); self.offset = 0; self.finished = False
+        self.thread = threading.Thread(target=self._inflate, name='gzip-reader', daemon=True)
+        self.thread.start()
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=0.5); return
+            except queue.Full:
+                continue
+    def _inflate(self):
+        try:
+            with open(self.path, 'rb') as f_in:
+                decompressor = zlib.decompressobj(31)
+                while not self.stopped.is_set():
+                    data = f_in.read(self.chunk_size)
+                    if not data: break
+                    while True:
+                        # 限制單次輸出大小，避免高壓縮比的惡意檔案一次吃光記憶體
+                        out = decompressor.decompress(data, self.chunk_size)
+                        if out: self._put(out)
+                        if decompressor.eof:
+                            # 一個 member 結束，剩下的位元組屬於下一個 member（尾端補零則忽略）
+                            data = decompressor.unused_data
+                            if not data.strip(b'\x00'): break
+                            decompressor = zlib.decompressobj(31)
+                        else:
+                            data = decompressor.unconsumed_tail
+                            if not data and len(out) < self.chunk_size: break
+                if not decompressor.eof and not self.stopped.is_set():
+                    raise tarfile.ReadError("gzip 資料不完整，檔案可能已損毀。")
+            self._put(self._EOF)
+        except zlib.error as e:
+            self._put(tarfile.ReadError(f"gzip 解壓失敗: {e}"))
+        except Exception as e:
+            self._put(e)
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.offset >= len(self.current):
+                if self.finished: break
+                item = self.chunks.get()
+                if item is self._EOF: self.finished = True
+                elif isinstance(item, Exception): self.finished = True; raise item
+                else: self.current = memoryview(item); self.offset = 0
+                continue
+            end = len(self.current) if size < 0 else min(len(self.current), self.offset + size)
+            parts.append(self.current[self.offset:end])
+            if size > 0: size -= end - self.offset
+            self.offset = end
+        return b''.join(parts)
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+def write_targz_layer(source_path, output_filename, level=GZIP_LEVEL):
+    with open(output_filename, 'wb') as f_out:
+        writer = ParallelGzipWriter(f_out, level)
+        with tarfile.open(fileobj=writer, mode='w|') as tf:
+            tf.add(source_path, arcname=os.path.basename(source_path))
+        writer.close()
+
+def extract_targz_layer(archive_path, output_path):
+    reader = ThreadedGzipReader(archive_path)
+    try:
+        with tarfile.open(fileobj=reader, mode='r|') as tf:
+            tf.extractall(path=output_path)
+    finally:
+        reader.close()
+
+# --- 檢查點 ---
+# 檢查點存在結果儲存區（GridFS 或共享檔案系統）而非 /tmp，節點被搶占後換一台機器也能續跑。
+def save_checkpoint(task_id, layer, artifact_path, password_file_content, layer_manifest):
+    file_id = storage.put_file(artifact_path, f"checkpoint_{os.path.basename(artifact_path)}")
+    checkpoint = {
+        'layer': layer, 'file_id': file_id, 'filename': os.path.basename(artifact_path),
+        'password_file_content': password_file_content, 'layer_manifest': layer_manifest,
+        'saved_at': datetime.utcnow()
+    }
+    previous = tasks_collection.find_one_and_update({'_id': task_id}, {'$set': {'checkpoint': checkpoint}}, projection={'checkpoint': 1})
+    if previous and previous.get('checkpoint'):
+        storage.delete(previous['checkpoint']['file_id'])
+
+def restore_checkpoint(checkpoint):
+    restored_path = os.path.join(OUTPUT_FOLDER, checkpoint['filename'])
+    storage.download_to(checkpoint['file_id'], restored_path)
+    return restored_path
+
+def discard_checkpoint(task_id):
+    previous = tasks_collection.find_one_and_update({'_id': task_id, 'checkpoint': {'$exists': True}}, {'$unset': {'checkpoint': ""}}, projection={'checkpoint': 1})
+    if previous and previous.get('checkpoint'):
+        storage.delete(previous['checkpoint']['file_id'])
+
+# --- 每層完整性清單 ---
+MANIFEST_HEADER = "--- 完整性清單（解壓縮時自動驗證，請勿修改）---"
+MANIFEST_PREFIX = "MANIFEST: "
+PASSWORD_CHECK_ITERATIONS = 50000
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def password_hash(password, salt):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), bytes.fromhex(salt), PASSWORD_CHECK_ITERATIONS).hex()
+
+def password_check(password, salt):
+    # 只保留 16 位元，用來在解壓前抓出打錯的密碼。只寫給密碼本身就印在密碼表上的層：
+    # 任何拿到密碼表的人都能用它離線篩掉大部分猜測，所以特殊密碼層一律不寫（改用 master_password_verifier）
+    return password_hash(password, salt)[:4]
+
+def master_password_verifier(master_pass):
+    """特殊密碼的完整驗證值，只存在伺服器端的任務文件，不進密碼表、清單或 /status。"""
+    salt = secrets.token_hex(16)
+    return {'salt': salt, 'hash': password_hash(master_pass, salt)}
+
+def new_layer_manifest(source_path):
+    return {
+        'version': 1, 'salt': secrets.token_hex(16),
+        'source': {'size': os.path.getsize(source_path), 'sha256': file_sha256(source_path)},
+        'layers': []
+    }
+
+def add_manifest_layer(manifest, layer, path, password, strategy=None):
+    entry = {
+        'layer': layer, 'filename': os.path.basename(path),
+        'size': os.path.getsize(path), 'sha256': file_sha256(path),
+        'pw_check': password_check(password, manifest['salt']) if password else None
+    }
+    if strategy: entry['strategy'] = strategy
+    manifest['layers'].append(entry)
+
+def render_layer_manifest(manifest):
+    return f"\n{MANIFEST_HEADER}\n{MANIFEST_PREFIX}{json.dumps(manifest, separators=(',', ':'))}\n"
+
+def parse_layer_manifest(password_text):
+    """從密碼表取出完整性清單；舊版密碼表沒有清單時回傳 None。"""
+    for line in (password_text or '').splitlines():
+        line = line.strip()
+        if not line.startswith(MANIFEST_PREFIX): continue
+        try:
+            manifest = json.loads(line[len(MANIFEST_PREFIX):])
+            if not isinstance(manifest.get('layers'), list): raise ValueError
+            return manifest
+        except (ValueError, AttributeError):
+            raise ValueError("密碼表中的完整性清單格式錯誤，請確認密碼表是否完整複製。")
+    return None
+
+def manifest_layer(manifest, filename):
+    if not manifest: return None
+    return next((entry for entry in manifest['layers'] if entry.get('filename') == filename), None)
+
+def verify_layer_passwords(password_list, master_pass, manifest):
+    """在建立任務前就比對每層密碼，打錯任何一層都不必先解開外層；相同的密碼只算一次。"""
+    if not manifest: return
+    computed = {}
+    def check(password):
+        if password not in computed: computed[password] = password_check(password, manifest['salt'])
+        return computed[password]
+    for layer_num, layer_info in enumerate(password_list, start=1):
+        password = layer_info['password']
+        if password == 'MASTER_PASSWORD_PLACEHOLDER':
+            # 特殊密碼層在清單中沒有檢查值，只能確認有填
+            if not master_pass: raise ValueError(f"第 {layer_num} 層需要特殊密碼。")
+            continue
+        entry = manifest_layer(manifest, layer_info['filename'])
+        if not entry or not entry.get('pw_check'): continue
+        if not password or check(password) != entry['pw_check']:
+            raise ValueError(f"第 {layer_num} 層 ({layer_info['filename']}) 的密碼與完整性清單不符，請確認密碼表是否正確。")
+
+def verify_master_password(password_list, master_pass, verifier):
+    """分享路由用：其他層的密碼來自伺服器自己的密碼表，只需核對使用者輸入的特殊密碼，且只算一次 PBKDF2。"""
+    if not any(layer['password'] == 'MASTER_PASSWORD_PLACEHOLDER' for layer in password_list): return
+    if not master_pass: raise ValueError("此檔案需要特殊密碼。")
+    # 舊任務沒有驗證值，就交給解壓縮本身判斷密碼
+    if verifier and not hmac.compare_digest(password_hash(master_pass, verifier['salt']), verifier['hash']):
+        raise ValueError("特殊密碼不正確。")
+
+def verify_layer_file(path, expected, label):
+    # 先比大小（不用讀檔），再串流計算 SHA-256
+    if os.path.isdir(path) or os.path.getsize(path) != expected['size'] or file_sha256(path) != expected['sha256']:
+        raise ValueError(f"{label}與完整性清單不符，檔案可能已損毀或與密碼表不對應，已中止解壓縮。")
+
+# --- 暫存空間預留 ---
+def estimate_temp_bytes(input_size):
+    # 執行中同時存在「輸入檔 + 上一層產物 + 正在寫入的這一層」，各層資料幾乎不可再壓縮，以 3 倍估計
+    return 3 * input_size
+
+def estimate_decompress_temp_bytes(input_size, layer_manifest):
+    """解壓縮所需的暫存空間。解出的內容可以比輸入大上千倍，不能照輸入大小估計。"""
+    if layer_manifest and layer_manifest.get('source'):
+        # 解開第 k 層時同時存在第 k 層與解出的第 k-1 層（原始檔算第 0 層），上傳檔則保留到任務結束
+        sizes = [layer_manifest['source']['size']] + [entry['size'] for entry in sorted(layer_manifest['layers'], key=lambda entry: entry['layer'])]
+        return input_size + max((inner + outer for inner, outer in zip(sizes, sizes[1:])), default=sizes[0])
+    # 沒有清單時只知道解壓上限：各層解出的內容合計不超過上限，多個檔案時還要再打包一份 ZIP
+    return input_size + 2 * MAX_DECOMPRESS_SIZE_BYTES
+
+def reserve_temp_space(task_id, nbytes, deadline):
+    """嘗試預留暫存空間，不會等待。
+
+    回傳 True 表示已預留；None 表示目前空間不足，應稍後重試；False 表示放棄（檔案超過磁碟容量、等待逾時或任務已取消）。
+    """
+    global reserved_temp_bytes
+    if nbytes > shutil.disk_usage(OUTPUT_FOLDER).total - TEMP_SPACE_MARGIN_BYTES:
+        update_task_log(task_id, "❌ 檔案所需的暫存空間超過伺服器磁碟容量。")
+        return False
+    with temp_space_lock:
+        # 可用空間 = 目前剩餘 - 其他任務已預留 - 安全邊際；已預留但尚未寫入的部分會被重複扣除，估計偏保守
+        if shutil.disk_usage(OUTPUT_FOLDER).free - reserved_temp_bytes - TEMP_SPACE_MARGIN_BYTES >= nbytes:
+            reserved_temp_bytes += nbytes
+            return True
+    if (tasks_collection.find_one({'_id': task_id}, {'cancel_requested': 1}) or {}).get('cancel_requested'):
+        update_task_log(task_id, "⚠️ 日誌: 操作已被使用者取消。")
+        tasks_collection.update_one({'_id': task_id}, {'$set': {'status': '已取消', 'progress_text': '任務已取消'}})
+        return False
+    if time.monotonic() > deadline:
+        update_task_log(task_id, "❌ 等待暫存空間逾時。")
+        return False
+    return None
+
+def release_temp_space(nbytes):
+    global reserved_temp_bytes
+    with temp_space_lock:
+        reserved_temp_bytes -= nbytes
+
+def sweep_temp_files():
+    """清除所屬任務已結束、已失去心跳或不存在的暫存檔；無法對應任務的檔案則依修改時間判斷。"""
+    now = time.time(); removed = 0
+    entries = []
+    for folder in (UPLOAD_FOLDER, OUTPUT_FOLDER):
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                continue
+            if age >= TEMP_SWEEP_GRACE_SECONDS:
+                match = TASK_FILE_PATTERN.match(name)
+                entries.append((path, match.group(1) if match else None, age))
+    task_ids = {ObjectId(task_id) for _, task_id, _ in entries if task_id}
+    # 只有「未結束且所屬程序仍有心跳」的任務算存活；程序中止或卡在 pending 的任務，檔案一樣清掉
+    stale_cutoff = datetime.utcnow() - timedelta(seconds=TASK_STALE_SECONDS)
+    live_task_ids = {str(t['_id']) for t in tasks_collection.find({
+        '_id': {'$in': list(task_ids)}, 'status': {'$nin': TERMINAL_STATUSES},
+        '$or': [
+            {'heartbeat_at': {'$gte': stale_cutoff}},
+            {'heartbeat_at': {'$exists': False}, 'created_at': {'$gte': stale_cutoff}}
+        ]
+    }, {'_id': 1})}
+    for path, task_id, age in entries:
+        if task_id in live_task_ids or (task_id is None and age < ORPHAN_FILE_MAX_AGE_SECONDS): continue
+        try:
+            if os.path.isdir(path): shutil.rmtree(path)
+            else: os.remove(path)
+            removed += 1
+        except OSError as e:
+            logging.warning(f"無法清除暫存檔 {path}: {e}")
+    if removed: logging.info(f"🧹 已清除 {removed} 個遺留的暫存檔。")
+    return removed
+
+# --- 背景維護：心跳、中斷任務續跑與暫存檔清理 ---
+def refresh_task_heartbeats():
+    tasks_collection.update_many({'owner': worker_id(), 'status': '處理中'}, {'$set': {'heartbeat_at': datetime.utcnow()}})
+
+def maintenance_loop():
+    global last_temp_sweep_at
+    while True:
+        try:
+            refresh_task_heartbeats()
+            resume_stale_tasks()
+            if time.monotonic() - last_temp_sweep_at >= TEMP_SWEEP_INTERVAL_SECONDS or not last_temp_sweep_at:
+                last_temp_sweep_at = time.monotonic()
+                sweep_temp_files()
+        except Exception as e:
+            logging.error(f"背景維護作業失敗: {e}", exc_info=True)
+        time.sleep(TASK_HEARTBEAT_SECONDS)
+
+def stale_task_query():
+    cutoff = datetime.utcnow() - timedelta(seconds=TASK_STALE_SECONDS)
+    return {'status': '處理中', '$or': [
+        {'heartbeat_at': {'$lt': cutoff}},
+        {'heartbeat_at': {'$exists': False}, 'created_at': {'$lt': cutoff}}
+    ]}
+
+def resume_stale_tasks():
+    """接手所屬程序已停止心跳的壓縮任務；有檢查點就從最後完成的層繼續。解壓縮任務沒有檢查點，直接標記失敗。"""
+    tasks_collection.update_many({**stale_task_query(), 'type': 'decompress'}, {
+        '$set': {'status': '失敗', 'progress_text': '任務失敗'},
+        '$push': {'logs': "❌ 處理此任務的程序已中止，請重新開始解壓縮。"}
+    })
+    stale_query = {**stale_task_query(), 'type': 'compress'}
+    while True:
+        task = tasks_collection.find_one_and_update(
+            stale_query,
+            {'$set': {'owner': worker_id(), 'heartbeat_at': datetime.utcnow()}, '$inc': {'resume_count': 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not task: break
+        if task.get('cancel_requested'):
+            tasks_collection.update_one({'_id': task['_id']}, {'$set': {'status': '已取消', 'progress_text': '任務已取消'}})
+            discard_checkpoint(task['_id']); continue
+        if task['resume_count'] > MAX_TASK_RESUMES:
+            update_task_log(task['_id'], f"❌ 任務已中斷續跑 {MAX_TASK_RESUMES} 次，不再重試。")
+            tasks_collection.update_one({'_id': task['_id']}, {'$set': {'status': '失敗', 'progress_text': '任務失敗'}})
+            discard_checkpoint(task['_id']); continue
+        update_task_log(task['_id'], f"♻️ 日誌: 偵測到中斷的任務，重新排入佇列（第 {task['resume_count']} 次續跑）。")
+        notify = task.get('notify', {})
+        executor.submit(task_wrapper, compression_worker, str(task['_id']), notify.get('recipient_email'), notify.get('host_url'),
+                        reserve_bytes=estimate_temp_bytes(task['params'].get('input_size', 0)))
+
+# --- zstd / LZ4 (tarzst / tarlz4 層) ---
+# zstd 低等級壓縮比 LZMA 快一個數量級、壓縮率相近，且 zstandard 內建多執行緒壓縮；LZ4 則以速度為優先。
+ZSTD_LEVEL = 3
+ZSTD_THREADS = int(os.environ.get('ZSTD_THREADS', GZIP_THREADS))
+
+def write_tarzst_layer(source_path, output_filename, level=ZSTD_LEVEL):
+    import zstandard
+    compressor = zstandard.ZstdCompressor(level=level, threads=ZSTD_THREADS if ZSTD_THREADS > 1 else 0)
+    with open(output_filename, 'wb') as f_out:
+        with compressor.stream_writer(f_out, closefd=False) as writer:
+            with tarfile.open(fileobj=writer, mode='w|') as tf:
+                tf.add(source_path, arcname=os.path.basename(source_path))
+
+def extract_tarzst_layer(archive_path, output_path):
+    import zstandard
+    try:
+        with open(archive_path, 'rb') as f_in, zstandard.ZstdDecompressor().stream_reader(f_in) as reader:
+            with tarfile.open(fileobj=reader, mode='r|') as tf:
+                tf.extractall(path=output_path)
+    except zstandard.ZstdError as e:
+        raise tarfile.ReadError(f"zstd 解壓失敗: {e}")
+
+def write_tarlz4_layer(source_path, output_filename):
+    import lz4.frame
+    with lz4.frame.open(output_filename, 'wb') as writer:
+        with tarfile.open(fileobj=writer, mode='w|') as tf:
+            tf.add(source_path, arcname=os.path.basename(source_path))
+
+def extract_tarlz4_layer(archive_path, output_path):
+    import lz4.frame
+    try:
+        with lz4.frame.open(archive_path, 'rb') as reader:
+            with tarfile.open(fileobj=reader, mode='r|') as tf:
+                tf.extractall(path=output_path)
+    except RuntimeError as e:
+        # lz4.frame 的格式錯誤以 RuntimeError 回報
+        raise tarfile.ReadError(f"LZ4 解壓失敗: {e}")
+
+# --- 自動壓縮策略 ---
+# 第一層之後的資料幾乎都已無法再壓縮，繼續用 LZMA / gzip 高壓縮等級只是白耗 CPU。
+# auto 模式先取樣試壓，再決定這一層用哪個壓縮等級；格式（副檔名）與加密需求不變，
+# 所以解壓縮端仍依副檔名選擇解碼器，結果完全相同。
+CODEC_SAMPLE_BLOCK_SIZE = 64 * 1024
+CODEC_SAMPLE_BLOCKS = 4
+CODEC_STORE_RATIO = 0.98  # 試壓後仍有原大小 98% 以上，視為不可壓縮，只封裝
+CODEC_FAST_RATIO = 0.7
+CODEC_STRATEGY_LABELS = {'store': '僅封裝', 'fast': '快速壓縮', 'default': '標準壓縮'}
+GZIP_STRATEGY_LEVELS = {'store': 0, 'fast': 1, 'default': GZIP_LEVEL}
+ZSTD_STRATEGY_LEVELS = {'store': 1, 'fast': 1, 'default': ZSTD_LEVEL}  # zstd 沒有純儲存模式，level 1 已接近 I/O 速度
+ADAPTIVE_LAYER_FORMATS = {'zip', '7z', 'targz', 'tarzst'}  # tarlz4 一律以預設等級壓縮
+
+def sample_compression_ratio(path):
+    """從檔案頭到尾平均取數個區塊，以 zlib level 1 試壓，回傳壓縮後 / 原始大小。"""
+    size = os.path.getsize(path)
+    if size == 0: return 1.0
+    last_offset = max(0, size - CODEC_SAMPLE_BLOCK_SIZE)
+    offsets = sorted({last_offset * k // (CODEC_SAMPLE_BLOCKS - 1) for k in range(CODEC_SAMPLE_BLOCKS)})
+    raw_bytes = 0; compressed_bytes = 0
+    with open(path, 'rb') as f_in:
+        for offset in offsets:
+            f_in.seek(offset)
+            block = f_in.read(CODEC_SAMPLE_BLOCK_SIZE)
+            raw_bytes += len(block); compressed_bytes += len(zlib.compress(block, 1))
+    return compressed_bytes / raw_bytes
+
+def choose_layer_strategy(path):
+    ratio = sample_compression_ratio(path)
+    if ratio >= CODEC_STORE_RATIO: return 'store', ratio
+    if ratio >= CODEC_FAST_RATIO: return 'fast', ratio
+    return 'default', ratio
+
+def seven_zip_filters(strategy, password):
+    import py7zr
+    if strategy == 'default': return None  # 沿用 py7zr 預設（LZMA2，有密碼時再加 AES）
+    filters = [{'id': py7zr.FILTER_COPY}] if strategy == 'store' else [{'id': py7zr.FILTER_LZMA2, 'preset': 1}]
+    if password: filters.append({'id': py7zr.FILTER_CRYPTO_AES256_SHA256})
+    return filters
+
+# --- QR Code 產生與快取 ---
+def render_qr_code(share_url, box_size, fmt):
+    import qrcode
+    qr = qrcode.QRCode(box_size=box_size, border=4)
+    qr.add_data(share_url)
+    qr.make(fit=True)
+    img_io = io.BytesIO()
+    if fmt == 'svg':
+        # SVG 直接輸出路徑文字，不經過 PIL 編碼
+        import qrcode.image.svg
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(img_io)
+    else:
+        qr.make_image().save(img_io, 'PNG')
+    return img_io.getvalue()
+
+def get_qr_code(share_url, box_size=QR_DEFAULT_BOX_SIZE, fmt='png'):
+    """回傳 (圖片內容, ETag)；最近用過的 QR_CACHE_SIZE 張留在記憶體中。"""
+    key = (share_url, box_size, fmt)
+    with qr_cache_lock:
+        cached = qr_cache.get(key)
+        if cached:
+            qr_cache.move_to_end(key)
+            return cached
+    # 在鎖外產生圖片，同時有多個請求時頂多重複產生一次，不會互相卡住
+    data = render_qr_code(share_url, box_size, fmt)
+    entry = (data, hashlib.sha256(data).hexdigest()[:32])
+    with qr_cache_lock:
+        qr_cache[key] = entry
+        qr_cache.move_to_end(key)
+        while len(qr_cache) > QR_CACHE_SIZE:
+            qr_cache.popitem(last=False)
+    return entry
+
+def share_url_for(host_url, task_id):
+    return f"{host_url}?share_id={task_id}"
 
 # --- 背景任務 ---
-def task_wrapper(func, *args, **kwargs):
+def task_wrapper(func, *args, reserve_bytes=0, space_deadline=None, **kwargs):
     global active_task_count
+    task_id = ObjectId(args[0])
+    first_attempt = space_deadline is None
+    if first_attempt: space_deadline = time.monotonic() + TEMP_SPACE_WAIT_SECONDS
+    reserved = reserve_temp_space(task_id, reserve_bytes, space_deadline)
+    if reserved is None:
+        # 空間不足時不佔著 worker 執行緒等待，稍後重新排入佇列，讓後面較小的任務先執行
+        if first_attempt: update_task_log(task_id, "⏳ 暫存空間不足，排隊等待其他任務釋放空間...", is_progress_text=True)
+        requeue = threading.Timer(TEMP_SPACE_RETRY_SECONDS, executor.submit, args=(task_wrapper, func, *args),
+                                  kwargs={**kwargs, 'reserve_bytes': reserve_bytes, 'space_deadline': space_deadline})
+        requeue.daemon = True
+        requeue.start()
+        return
+    if not reserved:
+        # 輸入檔留給暫存檔清理程序處理
+        tasks_collection.update_one({'_id': task_id, 'status': '處理中'}, {'$set': {'status': '失敗', 'progress_text': '任務失敗'}})
+        return
     with task_lock:
         active_task_count += 1
     try:
         func(*args, **kwargs)
     finally:
+        release_temp_space(reserve_bytes)
         with task_lock:
             active_task_count -= 1
         
 def compression_worker(task_id_str, recipient_email=None, host_url=None):
+    import py7zr
     task_id = ObjectId(task_id_str)
     task = tasks_collection.find_one({'_id': task_id});
     if not task: return
     params = task['params']; original_file = params['original_file']
+    checkpoint = task.get('checkpoint')
     try:
         iterations = params['iterations']
-        password_file_content = "--- 壓縮密碼表 ---\n"
-        formats = {'zip':'.zip', '7z':'.7z', 'targz':'.tar.gz'}
-        current_file = original_file
-        for i in range(1, iterations + 1):
+        if checkpoint:
+            update_task_log(task_id, f"♻️ 日誌: 從第 {checkpoint['layer']} 層的檢查點繼續壓縮。", is_progress_text=True)
+            current_file = restore_checkpoint(checkpoint)
+            password_file_content = checkpoint['password_file_content']
+            # 升級前留下的檢查點沒有清單，這種任務就不產生完整性清單
+            layer_manifest = checkpoint.get('layer_manifest')
+            start_layer = checkpoint['layer'] + 1
+        else:
+            if not os.path.exists(original_file): raise ValueError("找不到原始上傳檔案，且沒有可用的檢查點，無法繼續任務。")
+            password_file_content = "--- 壓縮密碼表 ---\n"
+            layer_manifest = new_layer_manifest(original_file)
+            current_file = original_file
+            start_layer = 1
+        for i in range(start_layer, iterations + 1):
             if tasks_collection.find_one({'_id': task_id}).get('cancel_requested'):
-                update_task_log(task_id, "⚠️ 日誌: 操作已被使用者取消。"); return
+                update_task_log(task_id, "⚠️ 日誌: 操作已被使用者取消。")
+                tasks_collection.update_one({'_id': task_id}, {'$set': {'status': '已取消', 'progress_text': '任務已取消'}}); return
             format_name = params['formats'][(i - 1) % len(params['formats'])]
-            output_filename = os.path.join(OUTPUT_FOLDER, f"{task_id_str}_layer_{i}{formats[format_name]}")
-            password = None; log_pwd = "(無密碼)"
+            output_filename = os.path.join(OUTPUT_FOLDER, f"{task_id_str}_layer_{i}{LAYER_FORMATS[format_name]}")
+            password = None; log_pwd = "(無密碼)"; is_master_layer = False
             if params['use_master_pass'] and i % params['master_pass_interval'] == 0:
-                password = params['master_pass']; log_pwd = "(特殊密碼層)"
+                password = params['master_pass']; log_pwd = "(特殊密碼層)"; is_master_layer = True
             elif (params['encrypt_odd'] and i % 2 != 0) or (not params['encrypt_odd'] and i in params['manual_layers']):
                 if format_name in ('zip', '7z'):
                     password = generate_password(); log_pwd = password
             password_file_content += f"第 {i} 層 ({os.path.basename(output_filename)}): {log_pwd}\n"
+            strategy = 'default'
+            # LZ4 沒有「僅封裝」模式，本身也已是最快的壓縮，不套用自動策略，密碼表也不記錄
+            adaptive = params.get('adaptive_codec') and format_name in ADAPTIVE_LAYER_FORMATS
+            if adaptive:
+                strategy, sample_ratio = choose_layer_strategy(current_file)
+                # 決策寫進密碼表（parse_password_text 會略過這一行），日後可追查每層實際用了什麼壓縮
+                password_file_content += f"    └ 自動策略: {CODEC_STRATEGY_LABELS[strategy]} (取樣壓縮率 {sample_ratio:.2f})\n"
             progress_text = f"正在壓縮第 {i}/{iterations} 層 (格式: {format_name})"
             update_task_log(task_id, f"--- {progress_text} ---", is_progress_text=True)
             if format_name in ('zip', '7z'):
-                with py7zr.SevenZipFile(output_filename, 'w', password=password) as z: z.write(current_file, os.path.basename(current_file))
+                with py7zr.SevenZipFile(output_filename, 'w', password=password, filters=seven_zip_filters(strategy, password)) as z:
+                    z.write(current_file, os.path.basename(current_file))
+            elif format_name == 'tarzst':
+                write_tarzst_layer(current_file, output_filename, level=ZSTD_STRATEGY_LEVELS[strategy])
+            elif format_name == 'tarlz4':
+                write_tarlz4_layer(current_file, output_filename)
             else:
-                with tarfile.open(output_filename, 'w:gz') as tf: tf.add(current_file, arcname=os.path.basename(current_file))
+                write_targz_layer(current_file, output_filename, level=GZIP_STRATEGY_LEVELS[strategy])
             if current_file != original_file: os.remove(current_file)
             current_file = output_filename
+            if layer_manifest is not None:
+                # 特殊密碼層不寫密碼檢查值，清單會隨密碼表公開給分享連結的持有者
+                add_manifest_layer(layer_manifest, i, current_file, None if is_master_layer else password, strategy if adaptive else None)
+            if CHECKPOINT_INTERVAL_LAYERS and i % CHECKPOINT_INTERVAL_LAYERS == 0 and i < iterations:
+                save_checkpoint(task_id, i, current_file, password_file_content, layer_manifest)
             update_task_progress(task_id, int((i / iterations) * 100))
         update_task_log(task_id, "✅ 壓縮流程結束。", is_progress_text=True)
-        with open(current_file, 'rb') as f_in:
-            file_id = fs.put(f_in, filename=os.path.basename(current_file))
-        os.remove(current_file)
+        file_id = storage.put_file(current_file, os.path.basename(current_file), move=True)
         delete_token = secrets.token_hex(16)
+        if host_url:
+            try:
+                # 分享頁與通知信會立刻要這張圖，在標記完成前先產生放進快取
+                get_qr_code(share_url_for(host_url, task_id_str))
+            except Exception as e:
+                logging.warning(f"預先產生 QR Code 失敗 ({task_id_str}): {e}")
+        uses_master_pass = params['use_master_pass'] and params.get('master_pass') and params['master_pass_interval'] <= iterations
+        if layer_manifest is not None:
+            # 機器可讀的清單附在密碼表最後，使用者複製整份密碼表手動解壓時也會一併帶上
+            password_file_content += render_layer_manifest(layer_manifest)
         tasks_collection.update_one({'_id': task_id}, {'$set': { 
             'status': '完成', 'progress': 100, 
             'result_file_id': str(file_id), 'result_filename': os.path.basename(current_file), 
-            'password_file_content': password_file_content, 'delete_token': delete_token
+            'password_file_content': password_file_content, 'layer_manifest': layer_manifest,
+            'master_pass_verifier': master_password_verifier(params['master_pass']) if uses_master_pass else None,
+            'delete_token': delete_token
         }})
         if recipient_email and host_url:
             try:
@@ -178,22 +986,33 @@ def compression_worker(task_id_str, recipient_email=None, host_url=None):
         tasks_collection.update_one({'_id': task_id}, {'$set': {'status': '失敗', 'progress_text': '任務失敗'}})
     finally:
         if 'original_file' in locals() and os.path.exists(original_file): os.remove(original_file)
+        if 'current_file' in locals() and current_file != original_file and os.path.exists(current_file): os.remove(current_file)
+        discard_checkpoint(task_id)
 
 def decompression_worker(task_id_str):
+    import py7zr
     task_id = ObjectId(task_id_str)
     task = tasks_collection.find_one({'_id': task_id});
     if not task: return
-    params = task['params']; original_file = params['original_file']
+    params = task['params']; original_file = params.get('original_file')
     output_path = os.path.join(OUTPUT_FOLDER, f"{task_id_str}_decompress_temp")
     try:
+        if params.get('source_file_id'):
+            # 分享連結的來源檔由 worker 自行從儲存區取出，不佔用請求執行緒。
+            update_task_log(task_id, "日誌: 正在讀取分享檔案...", is_progress_text=True)
+            original_file = os.path.join(UPLOAD_FOLDER, f"{task_id_str}_share_{secure_filename(params['source_filename'])}")
+            storage.download_to(params['source_file_id'], original_file)
         password_list = params['password_list']
         master_pass = params.get('master_pass')
         if not password_list: raise ValueError("找不到可用的密碼表。")
+        layer_manifest = params.get('layer_manifest')
+        if not layer_manifest: update_task_log(task_id, "日誌: 密碼表未附完整性清單，將略過逐層驗證。")
         current_file = original_file; total_layers = len(password_list)
         total_uncompressed_size = 0
         for i, layer_info in enumerate(reversed(password_list)):
             if tasks_collection.find_one({'_id': task_id}).get('cancel_requested'):
-                update_task_log(task_id, "⚠️ 日誌: 操作已被使用者取消。"); return
+                update_task_log(task_id, "⚠️ 日誌: 操作已被使用者取消。")
+                tasks_collection.update_one({'_id': task_id}, {'$set': {'status': '已取消', 'progress_text': '任務已取消'}}); return
             layer_num = total_layers - i
             password = layer_info['password']
             if password == 'MASTER_PASSWORD_PLACEHOLDER':
@@ -202,11 +1021,22 @@ def decompression_worker(task_id_str):
             
             progress_text = f"正在解壓縮第 {layer_num}/{total_layers} 層"
             update_task_log(task_id, f"--- {progress_text} ---", is_progress_text=True)
+
+            # 解開之前先核對這一層的大小與雜湊，損毀或放錯檔案時在這一層就中止
+            expected_layer = manifest_layer(layer_manifest, layer_info['filename'])
+            if expected_layer:
+                verify_layer_file(current_file, expected_layer, "上傳的檔案" if i == 0 else f"第 {layer_num} 層")
             
             os.makedirs(output_path, exist_ok=True)
             if layer_info['filename'].endswith(('.zip', '.7z')):
                 with py7zr.SevenZipFile(current_file, 'r', password=password) as z:
                     z.extractall(path=output_path)
+            elif layer_info['filename'].endswith('.tar.gz'):
+                extract_targz_layer(current_file, output_path)
+            elif layer_info['filename'].endswith('.tar.zst'):
+                extract_tarzst_layer(current_file, output_path)
+            elif layer_info['filename'].endswith('.tar.lz4'):
+                extract_tarlz4_layer(current_file, output_path)
             else:
                 with tarfile.open(current_file, 'r:*') as tf:
                     tf.extractall(path=output_path)
@@ -221,7 +1051,7 @@ def decompression_worker(task_id_str):
             if not extracted_items: raise Exception("解壓縮後找不到任何檔案。")
             
             next_item_path = os.path.join(output_path, extracted_items[0])
-            moved_item_path = os.path.join(OUTPUT_FOLDER, extracted_items[0])
+            moved_item_path = os.path.join(OUTPUT_FOLDER, f"{task_id_str}_{extracted_items[0]}")
             shutil.move(next_item_path, moved_item_path)
             shutil.rmtree(output_path)
             current_file = moved_item_path
@@ -234,7 +1064,7 @@ def decompression_worker(task_id_str):
             update_task_log(task_id, "日誌: 偵測到多個檔案，將打包成 ZIP 檔。")
             final_zip_name_base = os.path.splitext(expected_filename)[0]
             final_filename_to_store = f"{final_zip_name_base}.zip"
-            final_archive_path = os.path.join(OUTPUT_FOLDER, final_filename_to_store)
+            final_archive_path = os.path.join(OUTPUT_FOLDER, f"{task_id_str}_{final_filename_to_store}")
 
             with zipfile.ZipFile(final_archive_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
                 for root, _, files in os.walk(current_file):
@@ -245,11 +1075,12 @@ def decompression_worker(task_id_str):
             file_to_upload = final_archive_path
         else:
             update_task_log(task_id, "日誌: 偵測到單一檔案，將保留原始檔名。")
+            if layer_manifest and layer_manifest.get('source'):
+                verify_layer_file(current_file, layer_manifest['source'], "解壓縮後的原始檔案")
             final_filename_to_store = expected_filename
             file_to_upload = current_file
 
-        with open(file_to_upload, 'rb') as f_in:
-            file_id = fs.put(f_in, filename=final_filename_to_store)
+        file_id = storage.put_file(file_to_upload, final_filename_to_store, move=True)
 
         tasks_collection.update_one({'_id': task_id}, {'$set': {
             'status': '完成', 'progress': 100, 
@@ -260,11 +1091,14 @@ def decompression_worker(task_id_str):
     except (py7zr.Bad7zFile, zipfile.BadZipFile, tarfile.ReadError) as e:
         update_task_log(task_id, f"❌ 檔案格式錯誤或已損毀: {e}")
         tasks_collection.update_one({'_id': task_id}, {'$set': {'status': '失敗', 'progress_text': '任務失敗'}})
+    except ValueError as e:
+        update_task_log(task_id, f"❌ {e}")
+        tasks_collection.update_one({'_id': task_id}, {'$set': {'status': '失敗', 'progress_text': '任務失敗'}})
     except Exception as e:
         logging.error(f"解壓縮任務 {task_id_str} 失敗: {e}", exc_info=True)
         tasks_collection.update_one({'_id': task_id}, {'$set': {'status': '失敗', 'progress_text': '任務失敗'}})
     finally:
-        if 'original_file' in locals() and os.path.exists(original_file): os.remove(original_file)
+        if original_file and os.path.exists(original_file): os.remove(original_file)
         if 'current_file' in locals() and os.path.exists(current_file):
             if os.path.isdir(current_file): shutil.rmtree(current_file)
             else: os.remove(current_file)
@@ -273,13 +1107,15 @@ def decompression_worker(task_id_str):
         if os.path.exists(output_path): shutil.rmtree(output_path)
 
 def send_completion_email(recipient_email, task_id, original_filename, host_url):
+    import smtplib
+    from email.message import EmailMessage
     if not MAIL_USERNAME or not MAIL_PASSWORD: raise Exception("伺服器未設定郵件功能。")
     msg = EmailMessage()
     msg['Subject'] = f"您的檔案「{original_filename}」已壓縮完成！"
     msg['From'] = MAIL_USERNAME
     msg['To'] = recipient_email
     download_url = f"{host_url}download/{task_id}"
-    share_url = f"{host_url}?share_id={task_id}"
+    share_url = share_url_for(host_url, task_id)
     html_content = f"<html><body><p>您好，</p><p>您先前提交的檔案 <b>{original_filename}</b> 已經成功壓縮完成了。</p><p>您可以透過以下連結進行操作：</p><ul><li><a href='{download_url}'><b>直接下載壓縮檔</b></a></li><li><a href='{share_url}'>產生分享連結與 QR Code</a></li></ul><p>感謝您的使用！</p></body></html>"
     msg.add_alternative(html_content, subtype='html')
     with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
@@ -318,15 +1154,24 @@ def compress_route():
             'formats': [x.strip() for x in request.form.get('formats', 'zip,7z,targz').split(',') if x.strip()],
             'use_master_pass': request.form.get('use_master_pass') == 'on',
             'master_pass': request.form.get('master_password'),
-            'master_pass_interval': int(request.form.get('master_password_interval', '10'))
+            'master_pass_interval': int(request.form.get('master_password_interval', '10')),
+            'adaptive_codec': request.form.get('codec_mode') == 'auto'
         }
+        validate_layer_formats(params['formats'])
 
-        task = {'type': 'compress', 'status': 'pending', 'params': params, 'created_at': datetime.utcnow(), 'ip_address': ip_address}
+        task = {
+            'type': 'compress', 'status': 'pending', 'params': params, 'created_at': datetime.utcnow(), 'ip_address': ip_address,
+            # 續跑時仍能寄出通知信；notify 欄位不會出現在 /status 回應中
+            'notify': {'recipient_email': request.form.get('recipient_email'), 'host_url': request.host_url},
+            'owner': worker_id(), 'heartbeat_at': datetime.utcnow()
+        }
         task_id = tasks_collection.insert_one(task).inserted_id
         filepath = os.path.join(UPLOAD_FOLDER, f"{str(task_id)}_{secure_filename(file.filename)}")
         file.save(filepath)
-        tasks_collection.update_one({'_id': task_id}, {'$set': {'params.original_file': filepath, 'status': '處理中', 'progress_text': '準備開始...'}})
-        executor.submit(task_wrapper, compression_worker, str(task_id), request.form.get('recipient_email'), request.host_url)
+        input_size = os.path.getsize(filepath)
+        tasks_collection.update_one({'_id': task_id}, {'$set': {'params.original_file': filepath, 'params.input_size': input_size, 'status': '處理中', 'progress_text': '準備開始...'}})
+        executor.submit(task_wrapper, compression_worker, str(task_id), request.form.get('recipient_email'), request.host_url,
+                        reserve_bytes=estimate_temp_bytes(input_size))
         return jsonify({'task_id': str(task_id)})
     except Exception as e:
         return handle_route_exception(e, 'compress')
@@ -342,60 +1187,126 @@ def decompress_manual_route():
         
         ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
 
+        password_text = request.form.get('passwords', '')
         params = { 
-            'password_list': parse_password_text(request.form.get('passwords', '')), 
+            'password_list': parse_password_text(password_text), 
+            'layer_manifest': parse_layer_manifest(password_text),
             'master_pass': request.form.get('master_password'), 
             'expected_filename': file.filename 
         }
         if not params['password_list']: raise ValueError("無法解析您提供的密碼表。")
+        verify_layer_passwords(params['password_list'], params['master_pass'], params['layer_manifest'])
         
         task = {
             'type': 'decompress', 
             'status': 'pending', 
             'params': params, 
             'created_at': datetime.utcnow(),
-            'ip_address': ip_address
+            'ip_address': ip_address,
+            'owner': worker_id(), 'heartbeat_at': datetime.utcnow()
         }
         task_id = tasks_collection.insert_one(task).inserted_id
         filepath = os.path.join(UPLOAD_FOLDER, f"{str(task_id)}_{secure_filename(file.filename)}")
         file.save(filepath)
-        tasks_collection.update_one({'_id': task_id}, {'$set': {'params.original_file': filepath, 'status': '處理中', 'progress_text': '準備開始...'}})
-        executor.submit(task_wrapper, decompression_worker, str(task_id))
+        input_size = os.path.getsize(filepath)
+        tasks_collection.update_one({'_id': task_id}, {'$set': {'params.original_file': filepath, 'params.input_size': input_size, 'status': '處理中', 'progress_text': '準備開始...'}})
+        executor.submit(task_wrapper, decompression_worker, str(task_id),
+                        reserve_bytes=estimate_decompress_temp_bytes(input_size, params['layer_manifest']))
         return jsonify({'task_id': str(task_id)})
     except Exception as e:
         if 'task_id' in locals(): tasks_collection.delete_one({'_id': task_id})
         return handle_route_exception(e, 'decompress_manual')
 
+def share_cache_key(compress_task_id, master_pass):
+    """同一份分享檔 + 同一組特殊密碼 → 同一個解壓結果；密碼只以雜湊形式出現在鍵中。"""
+    pass_digest = hashlib.sha256(f"{compress_task_id}:{master_pass or ''}".encode('utf-8')).hexdigest()
+    return f"{compress_task_id}:{pass_digest}"
+
+def find_reusable_share_task(cache_key):
+    """回傳 (快取指標目前指向的任務 ID, 可重用的任務或 None)。
+
+    可重用：已完成且結果仍在，或仍在處理中且所屬程序的心跳未逾時（程序中止的任務不再併入）。
+    """
+    pointer = db['share_cache'].find_one({'_id': cache_key})
+    if not pointer: return None, None
+    now = datetime.utcnow()
+    task = tasks_collection.find_one({
+        '_id': pointer['task_id'], 'cancel_requested': {'$ne': True},
+        '$or': [
+            {'status': '完成', 'result_file_id': {'$exists': True}},
+            {'status': '處理中', 'heartbeat_at': {'$gte': now - timedelta(seconds=TASK_STALE_SECONDS)},
+             'created_at': {'$gte': now - timedelta(seconds=SHARE_COALESCE_WINDOW_SECONDS)}}
+        ]
+    }, {'_id': 1})
+    return pointer['task_id'], task
+
+def claim_share_task(cache_key, expected_task_id, new_task_id):
+    """把快取指標從 expected_task_id 換成 new_task_id；指標已被其他請求（或其他 worker 程序）換掉時回傳 False。
+
+    share_cache 以快取鍵為 _id，upsert 撞到別人剛寫入的指標會得到 DuplicateKeyError，所以跨程序也是原子操作。
+    """
+    try:
+        db['share_cache'].find_one_and_update(
+            {'_id': cache_key, 'task_id': expected_task_id},
+            {'$set': {'task_id': new_task_id, 'updated_at': datetime.utcnow()}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
 @app.route('/start-shared-decompression/<compress_task_id>', methods=['POST'])
 def start_shared_decompression(compress_task_id):
-    if active_task_count >= MAX_CONCURRENT_TASKS:
-        return jsonify({'error': '伺服器目前忙碌中，請稍後再試。'}), 429
     try:
         if db is None: return jsonify({'error': '資料庫未連線'}), 500
         original_task = tasks_collection.find_one({'_id': ObjectId(compress_task_id)})
         if not original_task or 'result_file_id' not in original_task: raise ValueError("找不到原始壓縮任務或檔案可能已被刪除。")
-        
-        ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
+        master_pass = (request.get_json(silent=True) or {}).get('master_password')
+        cache_key = share_cache_key(compress_task_id, master_pass)
+        password_list = None
 
-        filepath = os.path.join(UPLOAD_FOLDER, f"share_{secure_filename(original_task['result_filename'])}")
-        grid_out = fs.get(ObjectId(original_task['result_file_id']))
-        with open(filepath, 'wb') as f_out:
-            for chunk in grid_out:
-                f_out.write(chunk)
-        params = {
-            'original_file': filepath, 'password_list': parse_password_text(original_task.get('password_file_content', '')),
-            'master_pass': request.get_json().get('master_password'), 'expected_filename': original_task.get('params', {}).get('raw_filename')
-        }
-        new_task = {
-            'type': 'decompress', 
-            'status': '處理中', 
-            'params': params, 
-            'created_at': datetime.utcnow(),
-            'ip_address': ip_address
-        }
-        new_task_id = tasks_collection.insert_one(new_task).inserted_id
-        tasks_collection.update_one({'_id': new_task_id}, {'$set': {'progress_text': '準備開始...'}})
-        executor.submit(task_wrapper, decompression_worker, str(new_task_id))
+        for _ in range(SHARE_CLAIM_ATTEMPTS):
+            # 已完成的結果直接重用；進行中的相同請求併入同一個任務，不再重複解壓。
+            pointed_task_id, cached_task = find_reusable_share_task(cache_key)
+            if cached_task:
+                return jsonify({'task_id': str(cached_task['_id']), 'cached': True})
+
+            if active_task_count >= MAX_CONCURRENT_TASKS:
+                return jsonify({'error': '伺服器目前忙碌中，請稍後再試。'}), 429
+
+            if password_list is None:
+                password_text = original_task.get('password_file_content', '')
+                password_list = parse_password_text(password_text)
+                layer_manifest = original_task.get('layer_manifest') or parse_layer_manifest(password_text)
+                # 特殊密碼打錯直接回 400，不建立任務也不佔用快取鍵；快取命中時完全不做這項計算
+                verify_master_password(password_list, master_pass, original_task.get('master_pass_verifier'))
+
+            ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
+            params = {
+                'source_file_id': original_task['result_file_id'], 'source_filename': original_task['result_filename'],
+                'input_size': storage.size(original_task['result_file_id']),
+                'password_list': password_list, 'layer_manifest': layer_manifest,
+                'master_pass': master_pass, 'expected_filename': original_task.get('params', {}).get('raw_filename')
+            }
+            new_task = {
+                'type': 'decompress',
+                'status': '處理中',
+                'params': params,
+                'share_cache_key': cache_key,
+                'progress_text': '準備開始...',
+                'created_at': datetime.utcnow(),
+                'ip_address': ip_address,
+                'owner': worker_id(), 'heartbeat_at': datetime.utcnow()
+            }
+            new_task_id = tasks_collection.insert_one(new_task).inserted_id
+            if claim_share_task(cache_key, pointed_task_id, new_task_id): break
+            # 另一個請求搶先建立了相同的任務：撤回自己的，下一輪會查到並併入對方
+            tasks_collection.delete_one({'_id': new_task_id})
+        else:
+            return jsonify({'error': '伺服器目前忙碌中，請稍後再試。'}), 429
+        # 來源檔由 worker 下載到本機，就是估計值裡一路保留到結束的輸入檔
+        executor.submit(task_wrapper, decompression_worker, str(new_task_id),
+                        reserve_bytes=estimate_decompress_temp_bytes(params['input_size'], layer_manifest))
         return jsonify({'task_id': str(new_task_id)})
     except Exception as e:
         return handle_route_exception(e, 'start_shared_decompression')
@@ -458,28 +1369,32 @@ def health_check():
         health['status'] = 'degraded'; health['database'] = f'disconnected: {str(e)}'; status_code = 503
     try:
         disk = shutil.disk_usage('/')
-        health['disk_space'] = {'total_gb': disk.total // (2**30), 'free_gb': disk.free // (2**30)}
+        health['disk_space'] = {'total_gb': disk.total // (2**30), 'free_gb': disk.free // (2**30), 'reserved_mb': reserved_temp_bytes // (2**20)}
         if (disk.free / disk.total) < 0.1:
              health['status'] = 'degraded'; health['disk_space']['warning'] = 'Low disk space'; status_code = 503
     except Exception as e:
         health['status'] = 'degraded'; health['disk_space'] = f'Error: {str(e)}'; status_code = 503
     return jsonify(health), status_code
-    
+
+@app.route('/ready')
+def readiness_check():
+    # /health 回報整體健康狀態；/ready 只回答「這個 worker 能不能接流量」，不會同步等待資料庫。
+    ready = {'ready': mongo_ready.is_set(), 'startup_ms': round(STARTUP_SECONDS * 1000, 1)}
+    if not ready['ready']:
+        ready['database'] = mongo_last_error or '連線中'
+        return jsonify(ready), 503
+    return jsonify(ready)
+
 @app.route('/storage-stats')
 def storage_stats():
     try:
         if db is None: return jsonify({'error': '資料庫未連線'}), 500
 
-        # 計算總使用空間
-        pipeline = [{'$group': {'_id': None, 'total_size': {'$sum': '$length'}}}]
-        result = list(db['fs.files'].aggregate(pipeline))
-        used_space_bytes = result[0]['total_size'] if result else 0
-
-        # 計算檔案數量
-        file_count = db['fs.files'].count_documents({})
+        # 計算總使用空間與檔案數量
+        used_space_bytes, file_count = storage.usage()
 
-        # MongoDB 免費版限制
-        total_space_bytes = 512 * 1024 * 1024  # 512 MB
+        # 儲存區容量上限（GridFS 預設為 MongoDB 免費版的 512 MB）
+        total_space_bytes = storage.quota_bytes()
 
         # 計算使用百分比
         usage_percent = round((used_space_bytes / total_space_bytes) * 100, 2)
@@ -503,7 +1418,7 @@ def storage_stats():
             'used_space_bytes': used_space_bytes,
             'used_space_mb': round(used_space_bytes / (1024 * 1024), 2),
             'total_space_bytes': total_space_bytes,
-            'total_space_mb': 512,
+            'total_space_mb': round(total_space_bytes / (1024 * 1024)),
             'available_bytes': available_bytes,
             'available_mb': round(available_bytes / (1024 * 1024), 2),
             'usage_percent': usage_percent,
@@ -525,13 +1440,46 @@ def cancel_task(task_id):
 @app.route('/status/<task_id>')
 def task_status(task_id):
     try:
-        task = tasks_collection.find_one({'_id': ObjectId(task_id)})
+        # 分享連結的持有者也會查這個路由：特殊密碼與其驗證值都不能回傳
+        task = tasks_collection.find_one({'_id': ObjectId(task_id)}, {'notify': 0, 'master_pass_verifier': 0, 'params.master_pass': 0})
         if task:
             task['_id'] = str(task['_id']); return jsonify(task)
         return jsonify({'error': '找不到任務'}), 404
     except Exception as e:
         return handle_route_exception(e, 'status')
 
+def progress_stream_max_seconds():
+    # async_server 會替換 time 模組；沒有替換代表跑在同步 worker 上
+    return PROGRESS_STREAM_MAX_SECONDS if gevent_patched('time') else PROGRESS_STREAM_SYNC_MAX_SECONDS
+
+@app.route('/progress-stream/<task_id>')
+def progress_stream(task_id):
+    # Server-Sent Events：在 async_server 的 gevent 模式下，每條長連線只佔一個 greenlet
+    try:
+        task_oid = ObjectId(task_id)
+        if not tasks_collection.find_one({'_id': task_oid}, {'_id': 1}):
+            return jsonify({'error': '找不到任務'}), 404
+    except Exception as e:
+        return handle_route_exception(e, 'progress_stream')
+
+    def generate():
+        last_payload = None
+        deadline = time.monotonic() + progress_stream_max_seconds()
+        yield f"retry: {PROGRESS_STREAM_RETRY_MS}\n\n"
+        while time.monotonic() < deadline:
+            task = tasks_collection.find_one({'_id': task_oid}, {'status': 1, 'progress': 1, 'progress_text': 1})
+            if not task: break
+            payload = {'status': task.get('status'), 'progress': task.get('progress', 0), 'progress_text': task.get('progress_text')}
+            if payload != last_payload:
+                yield f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+                last_payload = payload
+            else:
+                yield ": keep-alive\n\n"
+            if payload['status'] in TERMINAL_STATUSES: break
+            time.sleep(PROGRESS_STREAM_POLL_SECONDS)
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/delete/<task_id>', methods=['POST'])
 def delete_file(task_id):
     try:
@@ -542,7 +1490,7 @@ def delete_file(task_id):
         if not task: return jsonify({'error': '找不到任務'}), 404
         if not secrets.compare_digest(task.get('delete_token', ""), token): return jsonify({'error': 'Token 無效'}), 403
         if 'result_file_id' in task and task['result_file_id']:
-            fs.delete(ObjectId(task['result_file_id']))
+            storage.delete(task['result_file_id'])
         tasks_collection.update_one({'_id': ObjectId(task_id)}, {
             '$unset': { 'result_file_id': "", 'result_filename': "", 'password_file_content': "", 'delete_token': "" },
             '$set': {'status': '已刪除'}
@@ -565,7 +1513,7 @@ def delete_batch():
                 task = tasks_collection.find_one({'_id': ObjectId(task_id)})
                 if task and secrets.compare_digest(task.get('delete_token', ""), token):
                     if 'result_file_id' in task and task['result_file_id']:
-                        fs.delete(ObjectId(task['result_file_id']))
+                        storage.delete(task['result_file_id'])
                     tasks_collection.update_one({'_id': ObjectId(task_id)}, {
                         '$unset': { 'result_file_id': "", 'result_filename': "", 'password_file_content': "", 'delete_token': "" },
                         '$set': {'status': '已刪除'}
@@ -586,10 +1534,7 @@ def delete_all_files():
         admin_secret_provided = request.get_json().get('admin_secret', "")
         if not secrets.compare_digest(admin_secret_provided, ADMIN_SECRET):
             return jsonify({'error': '管理員密碼錯誤'}), 403
-        all_files = list(db.fs.files.find({}))
-        deleted_count = len(all_files)
-        for file_doc in all_files:
-            fs.delete(file_doc['_id'])
+        deleted_count = storage.delete_all()
         tasks_collection.update_many(
             {'result_file_id': {'$exists': True}},
             {'$set': {'status': '已刪除 (管理員清除)'},
@@ -602,11 +1547,16 @@ def delete_all_files():
 @app.route('/qrcode/<task_id>')
 def generate_qr_code(task_id):
     try:
-        share_url = f"{request.host_url}?share_id={task_id}"
-        img_io = io.BytesIO()
-        qrcode.make(share_url).save(img_io, 'PNG')
-        img_io.seek(0)
-        return send_file(img_io, mimetype='image/png')
+        fmt = request.args.get('format', 'png').lower()
+        if fmt not in QR_FORMATS: raise ValueError("不支援的 QR Code 格式，請使用 png 或 svg。")
+        box_size = min(max(request.args.get('size', QR_DEFAULT_BOX_SIZE, type=int), QR_MIN_BOX_SIZE), QR_MAX_BOX_SIZE)
+        data, etag = get_qr_code(share_url_for(request.host_url, task_id), box_size, fmt)
+        response = Response(data, mimetype=QR_FORMATS[fmt])
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = QR_CACHE_MAX_AGE_SECONDS
+        # If-None-Match 相符時回 304，不再傳送圖片
+        return response.make_conditional(request)
     except Exception as e:
         return handle_route_exception(e, 'qrcode')
 
@@ -617,14 +1567,16 @@ def download_file(task_id):
         if not task or 'result_file_id' not in task:
             return "檔案可能已被刪除或不存在。", 404
         
-        grid_out = fs.get(ObjectId(task['result_file_id']))
-        response = send_file(grid_out, mimetype='application/octet-stream', as_attachment=True, download_name=task['result_filename'])
+        response = storage.send(task['result_file_id'], task['result_filename'])
         encoded_filename = quote(task['result_filename'].encode('utf-8'))
         response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{encoded_filename}"
         return response
     except Exception as e:
         return handle_route_exception(e, 'download')
 
+STARTUP_SECONDS = time.perf_counter() - _import_started_at
+logging.info(f"應用程式載入耗時 {STARTUP_SECONDS * 1000:.1f} ms")
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
 
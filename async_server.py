@@ -0,0 +1,49 @@
+"""
+非同步服務模式入口（gevent）
+
+同步 worker 下，每個慢速上傳、/download 串流或 /progress-stream 長連線都會佔住一整個 worker 程序。
+此模式讓 I/O 型路由以 greenlet 處理，單一程序即可同時服務數千個連線；
+壓縮 / 解壓縮仍在 app.executor 的原生執行緒上執行，不會卡住事件迴圈。
+
+用法：
+    gunicorn -k async_server.NativeThreadGeventWorker --worker-connections 2000 --timeout 120 app:app
+    python async_server.py   # 單一程序，本機測試用
+"""
+import os
+
+from gevent import monkey, socket as gevent_socket
+from gunicorn.workers.ggevent import GeventWorker
+
+# socket / ssl / dns 照常替換，資料庫與用戶端 I/O 都只讓出事件迴圈；thread、queue 保持原生，原因見下方說明
+PATCH_OPTIONS = dict(thread=False, queue=False)
+
+
+class NativeThreadGeventWorker(GeventWorker):
+    """與 gunicorn 內建 gevent worker 相同，但不替換 threading。
+
+    內建 worker 會 patch_all()，把 ThreadPoolExecutor 與 threading.Lock 變成 greenlet 版本，
+    CPU 密集的壓縮工作就會在事件迴圈裡執行並阻塞所有連線，所以這裡保留原生執行緒。
+    queue 也不能替換：ThreadPoolExecutor 內部的 queue.SimpleQueue 若換成 gevent 版本，跨原生執行緒使用會卡死。
+
+    gevent socket 綁定建立它的執行緒，所以 app 偵測到 socket 已被替換時，會讓每個原生執行緒各用一組
+    MongoClient（見 app.ThreadMongoHandle）：請求 greenlet 的查詢、/progress-stream 輪詢與 GridFS 下載
+    都走 hub 執行緒的連線池，等待資料庫時只讓出事件迴圈；executor 與背景維護執行緒不會碰到它們的 socket。
+    """
+
+    def patch(self):
+        monkey.patch_all(**PATCH_OPTIONS)
+        self.sockets = [
+            gevent_socket.socket(s.FAMILY, gevent_socket.SOCK_STREAM, fileno=s.sock.detach())
+            for s in self.sockets
+        ]
+
+
+if __name__ == '__main__':
+    monkey.patch_all(**PATCH_OPTIONS)
+    from gevent.pywsgi import WSGIServer
+    from app import app
+
+    port = int(os.environ.get('PORT', 8080))
+    print(f"非同步模式啟動於 0.0.0.0:{port}")
+    # WSGIServer 收到位址時會自行建立 gevent 監聽 socket
+    WSGIServer(('0.0.0.0', port), app).serve_forever()
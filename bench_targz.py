@@ -0,0 +1,79 @@
+"""
+targz 層解壓效能比較
+
+以同一個 targz 層比較標準函式庫 tarfile 'r:gz' 與 extract_targz_layer（背景執行緒解壓）的耗時，
+分別測試「幾乎不可再壓縮」（實際多層壓縮的內層）與「文字類」兩種內容，各取多次執行的中位數。
+
+用法：
+    python bench_targz.py
+    python bench_targz.py --mb 100 --runs 7
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app import write_targz_layer, extract_targz_layer  # noqa: E402
+
+
+def make_payload(path, kind, size_mb):
+    size = size_mb * 1024 * 1024
+    with open(path, 'wb') as f:
+        if kind == 'random':
+            f.write(os.urandom(size))
+            return
+        rng = random.Random(1)
+        words = [bytes(rng.choice(b'abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9))) for _ in range(5000)]
+        written = 0
+        while written < size:
+            line = b' '.join(rng.choice(words) for _ in range(20000)) + b'\n'
+            f.write(line); written += len(line)
+
+
+def stock_extract(archive_path, output_path):
+    with tarfile.open(archive_path, 'r:gz') as tf:
+        tf.extractall(path=output_path)
+
+
+def time_extract(extract, archive_path, workdir, runs):
+    timings = []
+    for _ in range(runs):
+        output_path = os.path.join(workdir, 'out')
+        shutil.rmtree(output_path, ignore_errors=True)
+        os.makedirs(output_path)
+        started = time.perf_counter()
+        extract(archive_path, output_path)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='targz 層解壓效能比較')
+    parser.add_argument('--mb', type=int, default=50, help='測試內容大小 (MB)')
+    parser.add_argument('--runs', type=int, default=5, help='每種方式執行次數（取中位數）')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_targz_')
+    try:
+        print(f"{'內容':<10}{'層大小 MB':>12}{'tarfile r:gz':>15}{'extract_targz_layer':>22}{'加速':>8}")
+        for kind in ('random', 'text'):
+            payload = os.path.join(workdir, f'{kind}.bin')
+            archive = os.path.join(workdir, f'{kind}.tar.gz')
+            make_payload(payload, kind, args.mb)
+            write_targz_layer(payload, archive)
+            stock = time_extract(stock_extract, archive, workdir, args.runs)
+            threaded = time_extract(extract_targz_layer, archive, workdir, args.runs)
+            layer_mb = os.path.getsize(archive) / 1024 / 1024
+            print(f"{kind:<10}{layer_mb:>12.1f}{stock:>14.3f}s{threaded:>21.3f}s{stock / threaded:>7.2f}x")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
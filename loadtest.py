@@ -0,0 +1,292 @@
+"""
+端對端壓力測試工具
+
+模擬 N 個使用者同時執行「上傳壓縮 → 輪詢狀態 → 查詢空間 → 下載 → 刪除」流程，
+回報各路由的 p50 / p95 / p99 延遲、429 比例、吞吐量與每個請求的資料庫操作數。
+
+預設在本機啟動真正的 app（真實 HTTP 伺服器），以 mongomock 取代 MongoDB / GridFS；
+也可以用 --target 對已部署的環境施壓（此時無法統計資料庫操作數）。
+
+用法：
+    pip install -r requirements-dev.txt
+    python loadtest.py --users 20 --duration 60
+    python loadtest.py --users 50 --flows 200 --json report.json
+    python loadtest.py --target https://staging.example.com --users 20
+"""
+import argparse
+import inspect
+import json
+import math
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import defaultdict
+
+TERMINAL_STATUSES = {'完成', '失敗', '已取消', '已刪除', '已刪除 (管理員清除)'}
+
+
+class OpCounter:
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def incr(self):
+        with self.lock:
+            self.count += 1
+
+
+class CountingProxy:
+    """包住 collection / GridFS / database，每次方法呼叫都算一次資料庫操作。"""
+
+    def __init__(self, target, counter):
+        self._target = target
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if inspect.isroutine(attr):
+            def counted(*args, **kwargs):
+                self._counter.incr()
+                return attr(*args, **kwargs)
+            return counted
+        # db.fs.files 這類子 collection 也要計數
+        return CountingProxy(attr, self._counter) if hasattr(attr, 'find_one') else attr
+
+    def __getitem__(self, name):
+        return CountingProxy(self._target[name], self._counter)
+
+
+def start_local_app(max_tasks, storage_backend):
+    """以 mongomock 啟動本機 app，回傳 (base_url, 資料庫操作計數器, 啟動耗時 ms)。"""
+    try:
+        import mongomock
+        import mongomock.gridfs
+    except ImportError:
+        sys.exit("本機模式需要 mongomock：pip install -r requirements-dev.txt")
+    import tempfile
+    from werkzeug.serving import make_server
+
+    os.environ['MAX_CONCURRENT_TASKS'] = str(max_tasks)
+    mongomock.gridfs.enable_gridfs_integration()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+
+    counter = OpCounter()
+    mongo = mongomock.MongoClient()
+    db = mongo['compressor_db']
+    app_module.client = mongo
+    app_module.db = CountingProxy(db, counter)
+    app_module.tasks_collection = CountingProxy(db['tasks'], counter)
+    if storage_backend == 'local':
+        app_module.storage = app_module.LocalStorage(tempfile.mkdtemp(prefix='loadtest_results_'))
+    else:
+        storage = app_module.GridFSStorage(db)
+        storage.db = CountingProxy(db, counter)
+        storage.fs = CountingProxy(storage.fs, counter)
+        app_module.storage = storage
+    app_module.mongo_ready.set()
+
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/", counter, app_module.STARTUP_SECONDS * 1000
+
+
+def http_request(method, url, data=None, headers=None, timeout=120):
+    """回傳 (狀態碼, 回應內容, 耗時秒數)；HTTP 錯誤也視為正常結果。"""
+    req = urllib.request.Request(url, data=data, method=method, headers=headers or {})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            body = resp.read()
+            return resp.status, body, time.perf_counter() - started
+    except urllib.error.HTTPError as e:
+        return e.code, e.read(), time.perf_counter() - started
+
+
+def multipart_body(fields, file_field, filename, payload):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'.encode() + payload + b'\r\n'
+    )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+
+class LoadTest:
+    def __init__(self, base_url, args):
+        self.base_url = base_url
+        self.args = args
+        self.samples = defaultdict(list)  # route -> [(latency, status)]
+        self.lock = threading.Lock()
+        self.flows_started = 0
+        self.flows_completed = 0
+        self.flows_failed = 0
+        self.stop_at = time.monotonic() + args.duration
+
+    def record(self, route, status, latency):
+        with self.lock:
+            self.samples[route].append((latency, status))
+
+    def call(self, route, method, path, **kwargs):
+        status, body, latency = http_request(method, self.base_url + path, **kwargs)
+        self.record(route, status, latency)
+        return status, body
+
+    def claim_flow(self):
+        with self.lock:
+            if time.monotonic() >= self.stop_at: return False
+            if self.args.flows and self.flows_started >= self.args.flows: return False
+            self.flows_started += 1
+            return True
+
+    def finish_flow(self, ok):
+        with self.lock:
+            if ok: self.flows_completed += 1
+            else: self.flows_failed += 1
+
+    def run_flow(self):
+        payload = os.urandom(self.args.file_kb * 512) + b'load-test ' * (self.args.file_kb * 52)
+        fields = {'iterations': self.args.layers, 'formats': self.args.formats}
+        body, headers = multipart_body(fields, 'file', 'loadtest.bin', payload)
+
+        while True:
+            status, resp = self.call('/compress', 'POST', 'compress', data=body, headers=headers)
+            if status != 429: break
+            if time.monotonic() >= self.stop_at: return False
+            time.sleep(self.args.backoff)
+        if status != 200: return False
+        task_id = json.loads(resp)['task_id']
+
+        task = {}
+        deadline = time.monotonic() + self.args.task_timeout
+        while time.monotonic() < deadline:
+            status, resp = self.call('/status', 'GET', f'status/{task_id}')
+            if status == 200:
+                task = json.loads(resp)
+                if task.get('status') in TERMINAL_STATUSES: break
+            time.sleep(self.args.poll_interval)
+        if task.get('status') != '完成': return False
+
+        self.call('/storage-stats', 'GET', 'storage-stats')
+        status, _ = self.call('/download', 'GET', f'download/{task_id}')
+        if status != 200: return False
+        status, _ = self.call('/delete', 'POST', f'delete/{task_id}',
+                              data=json.dumps({'token': task.get('delete_token', '')}).encode(),
+                              headers={'Content-Type': 'application/json'})
+        return status == 200
+
+    def user_loop(self):
+        while self.claim_flow():
+            try:
+                ok = self.run_flow()
+            except Exception as e:
+                print(f"流程發生例外: {e}", file=sys.stderr)
+                ok = False
+            self.finish_flow(ok)
+
+    def run(self):
+        started = time.monotonic()
+        users = [threading.Thread(target=self.user_loop, daemon=True) for _ in range(self.args.users)]
+        for user in users: user.start()
+        for user in users: user.join()
+        return time.monotonic() - started
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values: return 0.0
+    # nearest-rank 百分位數
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def build_report(test, elapsed, db_counter, startup_ms):
+    routes = {}
+    total_requests = 0; total_429 = 0
+    for route, samples in sorted(test.samples.items()):
+        latencies = sorted(latency * 1000 for latency, _ in samples)
+        rate_limited = sum(1 for _, status in samples if status == 429)
+        errors = sum(1 for _, status in samples if status >= 500)
+        total_requests += len(samples); total_429 += rate_limited
+        routes[route] = {
+            'requests': len(samples),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            'max_ms': round(latencies[-1], 1) if latencies else 0.0,
+            'rate_limited': rate_limited,
+            'errors_5xx': errors,
+        }
+    return {
+        'users': test.args.users,
+        'elapsed_seconds': round(elapsed, 2),
+        'startup_ms': round(startup_ms, 1) if startup_ms is not None else None,
+        'flows_completed': test.flows_completed,
+        'flows_failed': test.flows_failed,
+        'requests': total_requests,
+        'throughput_rps': round(total_requests / elapsed, 2) if elapsed else 0.0,
+        'flows_per_second': round(test.flows_completed / elapsed, 3) if elapsed else 0.0,
+        'rate_limited_ratio': round(total_429 / total_requests, 4) if total_requests else 0.0,
+        # 含背景 worker 對資料庫的操作，反映每個請求實際帶來的資料庫負載
+        'db_ops_per_request': round(db_counter.count / total_requests, 2) if db_counter and total_requests else None,
+        'routes': routes,
+    }
+
+
+def print_report(report):
+    print(f"\n使用者: {report['users']}  耗時: {report['elapsed_seconds']}s  啟動耗時: {report['startup_ms']} ms")
+    print(f"完成流程: {report['flows_completed']}  失敗流程: {report['flows_failed']}  "
+          f"吞吐量: {report['throughput_rps']} req/s ({report['flows_per_second']} flows/s)")
+    print(f"429 比例: {report['rate_limited_ratio'] * 100:.2f}%  每請求資料庫操作數: {report['db_ops_per_request']}")
+    print(f"\n{'路由':<16}{'請求數':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}{'429':>7}{'5xx':>7}")
+    for route, stats in report['routes'].items():
+        print(f"{route:<16}{stats['requests']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}"
+              f"{stats['max_ms']:>10}{stats['rate_limited']:>7}{stats['errors_5xx']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='壓縮服務端對端壓力測試')
+    parser.add_argument('--target', help='已部署服務的網址；省略時在本機以 mongomock 啟動 app')
+    parser.add_argument('--users', type=int, default=10, help='同時模擬的使用者數')
+    parser.add_argument('--duration', type=float, default=60, help='最長測試秒數')
+    parser.add_argument('--flows', type=int, default=0, help='總流程數上限（0 表示只看時間）')
+    parser.add_argument('--file-kb', type=int, default=256, help='每次上傳的檔案大小 (KB)')
+    parser.add_argument('--layers', type=int, default=3, help='壓縮層數')
+    parser.add_argument('--formats', default='zip,7z,targz', help='壓縮格式順序')
+    parser.add_argument('--storage', choices=['gridfs', 'local'], default='gridfs', help='本機模式使用的結果儲存方式')
+    parser.add_argument('--max-tasks', type=int, default=3, help='本機模式的 MAX_CONCURRENT_TASKS')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='輪詢 /status 的間隔秒數')
+    parser.add_argument('--backoff', type=float, default=1.0, help='收到 429 後的等待秒數')
+    parser.add_argument('--task-timeout', type=float, default=300, help='單一任務的等待上限秒數')
+    parser.add_argument('--json', help='另存 JSON 報告的路徑，方便部署前比對')
+    args = parser.parse_args()
+
+    db_counter = None
+    if args.target:
+        base_url = args.target.rstrip('/') + '/'
+        _, body, _ = http_request('GET', base_url + 'ready')
+        try:
+            startup_ms = json.loads(body).get('startup_ms')
+        except ValueError:
+            startup_ms = None
+    else:
+        base_url, db_counter, startup_ms = start_local_app(args.max_tasks, args.storage)
+
+    test = LoadTest(base_url, args)
+    elapsed = test.run()
+    report = build_report(test, elapsed, db_counter, startup_ms)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,35 @@ def client():
         yield client
 
 
+class RecordingExecutor:
+    """只记录提交的任务，不实际执行"""
+
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.calls.append((fn, args, kwargs))
+
+
+@pytest.fixture
+def mongo_app(monkeypatch, tmp_path):
+    """以 mongomock 取代 MongoDB，结果与暂存文件放在临时目录"""
+    mongomock = pytest.importorskip('mongomock')
+    import app as app_module
+    mongo = mongomock.MongoClient()
+    db = mongo['compressor_db']
+    monkeypatch.setattr(app_module, 'client', mongo)
+    monkeypatch.setattr(app_module, 'db', db)
+    monkeypatch.setattr(app_module, 'tasks_collection', db['tasks'])
+    monkeypatch.setattr(app_module, 'storage', app_module.LocalStorage(str(tmp_path / 'results')))
+    for name in ('UPLOAD_FOLDER', 'OUTPUT_FOLDER'):
+        folder = tmp_path / name.lower()
+        folder.mkdir()
+        monkeypatch.setattr(app_module, name, str(folder))
+    monkeypatch.setattr(app_module, 'executor', RecordingExecutor())
+    return app_module
+
+
 class TestHealthCheck:
     """健康检查端点测试"""
 
@@ -33,6 +62,12 @@ class TestHealthCheck:
         # 首页返回 HTML
         assert 'text/html' in response.content_type
 
+    def test_ready_endpoint_without_database(self, client):
+        """测试就绪端点（未连线数据库时应返回 503 并附带启动耗时）"""
+        response = client.get('/ready')
+        assert response.status_code in [200, 503]
+        assert 'startup_ms' in response.get_json()
+
     def test_task_status_endpoint_invalid_id(self, client):
         """测试任务状态端点（无效ID）"""
         response = client.get('/status/invalid_task_id')
@@ -137,6 +172,63 @@ class TestDecompressionAPI:
         assert response.status_code in [200, 201, 400, 429, 500]
 
 
+class TestSharedDecompression:
+    """分享解压缓存测试"""
+
+    def test_share_cache_key_depends_on_password(self):
+        """测试缓存键依赖任务 ID 与特殊密码，且不包含明文密码"""
+        from app import share_cache_key
+        key = share_cache_key('abc', 'secret')
+        assert key == share_cache_key('abc', 'secret')
+        assert key != share_cache_key('abc', 'other')
+        assert key != share_cache_key('xyz', 'secret')
+        assert 'secret' not in key
+
+    def test_start_shared_decompression_invalid_id(self, client):
+        """测试无效的分享任务 ID"""
+        response = client.post('/start-shared-decompression/invalid_id', json={})
+        assert response.status_code in [400, 404, 500]
+
+    def _shared_task(self, app_module, tmp_path):
+        result = tmp_path / 'shared.7z'
+        result.write_bytes(b'7z\xbc\xaf\x27\x1c' + b'\x00' * 64)
+        file_id = app_module.storage.put_file(str(result), 'shared.7z')
+        return app_module.tasks_collection.insert_one({
+            'type': 'compress', 'status': '完成', 'result_file_id': file_id, 'result_filename': 'shared.7z',
+            'password_file_content': '第 1 層 (shared.7z): (無密碼)\n', 'params': {'raw_filename': 'a.txt'}
+        }).inserted_id
+
+    def test_requests_coalesce_onto_live_task(self, client, mongo_app, tmp_path):
+        """测试相同请求并入心跳正常的处理中任务"""
+        share_id = self._shared_task(mongo_app, tmp_path)
+        first = client.post(f'/start-shared-decompression/{share_id}', json={}).get_json()
+        second = client.post(f'/start-shared-decompression/{share_id}', json={}).get_json()
+        assert second == {'task_id': first['task_id'], 'cached': True}
+        assert len(mongo_app.executor.calls) == 1
+
+    def test_dead_task_is_not_reused(self, client, mongo_app, tmp_path):
+        """测试所属进程已停止心跳的任务不再被并入，并由维护程序标记为失败"""
+        from bson import ObjectId
+        from datetime import datetime, timedelta
+        share_id = self._shared_task(mongo_app, tmp_path)
+        first = client.post(f'/start-shared-decompression/{share_id}', json={}).get_json()
+        stale_at = datetime.utcnow() - timedelta(seconds=mongo_app.TASK_STALE_SECONDS + 60)
+        mongo_app.tasks_collection.update_one({'_id': ObjectId(first['task_id'])}, {'$set': {'heartbeat_at': stale_at}})
+
+        second = client.post(f'/start-shared-decompression/{share_id}', json={}).get_json()
+        assert second['task_id'] != first['task_id'] and 'cached' not in second
+        mongo_app.resume_stale_tasks()
+        assert mongo_app.tasks_collection.find_one({'_id': ObjectId(first['task_id'])})['status'] == '失敗'
+        assert mongo_app.tasks_collection.find_one({'_id': ObjectId(second['task_id'])})['status'] == '處理中'
+
+    def test_claim_is_compare_and_swap(self, mongo_app):
+        """测试快取指标只能从预期的任务换成新任务"""
+        assert mongo_app.claim_share_task('key', None, 'task-a')
+        assert not mongo_app.claim_share_task('key', None, 'task-b')
+        assert mongo_app.claim_share_task('key', 'task-a', 'task-c')
+        assert mongo_app.db['share_cache'].find_one({'_id': 'key'})['task_id'] == 'task-c'
+
+
 class TestTaskManagement:
     """任务管理 API 测试"""
 
@@ -156,6 +248,492 @@ class TestTaskManagement:
         assert response.status_code in [200, 404, 500]
 
 
+class TestTempSpace:
+    """暂存空间预留与清理测试"""
+
+    GB = 1024 ** 3
+
+    def _disk(self, monkeypatch, app_module, free_gb, total_gb=100):
+        from collections import namedtuple
+        usage = namedtuple('usage', 'total used free')(total_gb * self.GB, (total_gb - free_gb) * self.GB, free_gb * self.GB)
+        monkeypatch.setattr(app_module.shutil, 'disk_usage', lambda path: usage)
+        monkeypatch.setattr(app_module, 'TEMP_SPACE_MARGIN_BYTES', 0)
+        monkeypatch.setattr(app_module, 'reserved_temp_bytes', 0)
+
+    def _task(self, app_module, **fields):
+        from datetime import datetime
+        doc = {'type': 'compress', 'status': '處理中', 'created_at': datetime.utcnow(), 'heartbeat_at': datetime.utcnow()}
+        doc.update(fields)
+        return app_module.tasks_collection.insert_one(doc).inserted_id
+
+    def test_reserve_and_release(self, mongo_app, monkeypatch):
+        """测试空间足够时预留、不足时要求重试、释放后可再次预留"""
+        import time
+        self._disk(monkeypatch, mongo_app, free_gb=10)
+        task_id = self._task(mongo_app)
+        deadline = time.monotonic() + 60
+        assert mongo_app.reserve_temp_space(task_id, 6 * self.GB, deadline) is True
+        assert mongo_app.reserve_temp_space(task_id, 6 * self.GB, deadline) is None
+        mongo_app.release_temp_space(6 * self.GB)
+        assert mongo_app.reserve_temp_space(task_id, 6 * self.GB, deadline) is True
+
+    def test_reserve_gives_up(self, mongo_app, monkeypatch):
+        """测试超过磁盘容量、等待逾时与已取消的任务都放弃预留"""
+        import time
+        self._disk(monkeypatch, mongo_app, free_gb=1)
+        task_id = self._task(mongo_app)
+        assert mongo_app.reserve_temp_space(task_id, 200 * self.GB, time.monotonic() + 60) is False
+        assert mongo_app.reserve_temp_space(task_id, 5 * self.GB, time.monotonic() - 1) is False
+        mongo_app.tasks_collection.update_one({'_id': task_id}, {'$set': {'cancel_requested': True}})
+        assert mongo_app.reserve_temp_space(task_id, 5 * self.GB, time.monotonic() + 60) is False
+        assert mongo_app.tasks_collection.find_one({'_id': task_id})['status'] == '已取消'
+
+    def test_waiting_task_does_not_hold_worker(self, mongo_app, monkeypatch):
+        """测试空间不足时任务重新排队，不占用 worker 线程"""
+        import time
+        self._disk(monkeypatch, mongo_app, free_gb=1)
+        monkeypatch.setattr(mongo_app, 'TEMP_SPACE_RETRY_SECONDS', 0)
+        task_id = self._task(mongo_app)
+        ran = []
+        mongo_app.task_wrapper(lambda task_id_str: ran.append(task_id_str), str(task_id), reserve_bytes=5 * self.GB)
+        for _ in range(100):
+            if mongo_app.executor.calls: break
+            time.sleep(0.01)
+        assert ran == [] and mongo_app.active_task_count == 0
+        (fn, args, kwargs), = mongo_app.executor.calls
+        assert fn is mongo_app.task_wrapper and kwargs['reserve_bytes'] == 5 * self.GB
+        self._disk(monkeypatch, mongo_app, free_gb=10)
+        fn(*args, **kwargs)
+        assert ran == [str(task_id)] and mongo_app.reserved_temp_bytes == 0
+
+    def test_decompress_estimate_covers_expanded_size(self, tmp_path):
+        """测试解压缩按清单中的原始大小预留空间，没有清单时按解压上限预留"""
+        import app as app_module
+        source = tmp_path / 'source.bin'
+        source.write_bytes(b'\0' * 50000)
+        manifest = app_module.new_layer_manifest(str(source))
+        for layer, size in ((1, 400), (2, 300)):
+            path = tmp_path / f'a_layer_{layer}.7z'
+            path.write_bytes(b'x' * size)
+            app_module.add_manifest_layer(manifest, layer, str(path), None)
+        assert app_module.estimate_decompress_temp_bytes(300, manifest) == 300 + 50000 + 400
+        assert app_module.estimate_decompress_temp_bytes(300, None) == 300 + 2 * app_module.MAX_DECOMPRESS_SIZE_BYTES
+
+    def test_manual_decompress_reserves_expanded_size(self, client, mongo_app):
+        """测试手动解压缩提交任务时预留的是解压后大小，而不是输入大小的倍数"""
+        data = {'file': (BytesIO(b'PK\x03\x04' + b'\x00' * 100), 'test.zip'), 'passwords': '第 1 層 (test.zip): abc123'}
+        assert client.post('/decompress-manual', data=data, content_type='multipart/form-data').status_code == 200
+        (fn, args, kwargs), = mongo_app.executor.calls
+        assert kwargs['reserve_bytes'] >= mongo_app.MAX_DECOMPRESS_SIZE_BYTES
+
+    def test_sweep_keeps_only_live_task_files(self, mongo_app):
+        """测试清理程序保留存活任务的文件，删除已结束、失去心跳与不存在任务的文件，并遵守宽限期"""
+        import time
+        from bson import ObjectId
+        from datetime import datetime, timedelta
+        stale_at = datetime.utcnow() - timedelta(seconds=mongo_app.TASK_STALE_SECONDS + 60)
+        live = self._task(mongo_app)
+        done = self._task(mongo_app, status='完成')
+        crashed = self._task(mongo_app, type='decompress', heartbeat_at=stale_at)
+        stuck_pending = self._task(mongo_app, status='pending', heartbeat_at=stale_at)
+        missing = ObjectId()
+        old = time.time() - mongo_app.TEMP_SWEEP_GRACE_SECONDS - 60
+
+        def temp_file(folder, name, mtime=old):
+            path = os.path.join(folder, name)
+            with open(path, 'wb') as f:
+                f.write(b'x')
+            os.utime(path, (mtime, mtime))
+            return path
+
+        kept = [temp_file(mongo_app.UPLOAD_FOLDER, f'{live}_input.bin'),
+                temp_file(mongo_app.UPLOAD_FOLDER, f'{missing}_fresh.bin', mtime=time.time()),
+                temp_file(mongo_app.OUTPUT_FOLDER, 'orphan_recent.bin')]
+        removed = [temp_file(mongo_app.UPLOAD_FOLDER, f'{done}_input.bin'),
+                   temp_file(mongo_app.UPLOAD_FOLDER, f'{crashed}_share_a.7z'),
+                   temp_file(mongo_app.UPLOAD_FOLDER, f'{stuck_pending}_input.bin'),
+                   temp_file(mongo_app.OUTPUT_FOLDER, f'{missing}_layer_1.7z'),
+                   temp_file(mongo_app.OUTPUT_FOLDER, 'orphan_old.bin', mtime=time.time() - mongo_app.ORPHAN_FILE_MAX_AGE_SECONDS - 60)]
+        temp_dir = os.path.join(mongo_app.OUTPUT_FOLDER, f'{crashed}_decompress_temp')
+        os.makedirs(temp_dir)
+        os.utime(temp_dir, (old, old))
+        removed.append(temp_dir)
+
+        assert mongo_app.sweep_temp_files() == len(removed)
+        assert all(os.path.exists(path) for path in kept)
+        assert not any(os.path.exists(path) for path in removed)
+
+
+class SimulatedCrash(BaseException):
+    """模拟进程中止：不会被 worker 的 except Exception 接住"""
+
+
+class TestCheckpointResume:
+    """检查点与中断续跑测试"""
+
+    def _stale(self, app_module, task_id, **fields):
+        from datetime import datetime, timedelta
+        stale_at = datetime.utcnow() - timedelta(seconds=app_module.TASK_STALE_SECONDS + 60)
+        app_module.tasks_collection.update_one({'_id': task_id}, {'$set': {'heartbeat_at': stale_at, **fields}})
+
+    def _compress_task(self, client, app_module, payload, iterations):
+        from bson import ObjectId
+        data = {'file': (BytesIO(payload), 'payload.bin'), 'iterations': str(iterations), 'formats': 'zip,targz,7z'}
+        response = client.post('/compress', data=data, content_type='multipart/form-data')
+        assert response.status_code == 200
+        return ObjectId(response.get_json()['task_id'])
+
+    def test_checkpoint_replaces_previous_and_discards(self, mongo_app, tmp_path):
+        """测试新检查点会删除旧的储存文件，discard 后不留下任何文件"""
+        task_id = mongo_app.tasks_collection.insert_one({'type': 'compress', 'status': '處理中'}).inserted_id
+        for layer in (2, 4):
+            artifact = tmp_path / f'{task_id}_layer_{layer}.7z'
+            artifact.write_bytes(b'layer %d' % layer)
+            mongo_app.save_checkpoint(task_id, layer, str(artifact), f'table {layer}', None)
+        checkpoint = mongo_app.tasks_collection.find_one({'_id': task_id})['checkpoint']
+        assert checkpoint['layer'] == 4
+        assert mongo_app.storage.usage()[1] == 1
+        restored = mongo_app.restore_checkpoint(checkpoint)
+        with open(restored, 'rb') as f:
+            assert f.read() == b'layer 4'
+        mongo_app.discard_checkpoint(task_id)
+        assert 'checkpoint' not in mongo_app.tasks_collection.find_one({'_id': task_id})
+        assert mongo_app.storage.usage() == (0, 0)
+
+    def test_crash_resume_round_trip(self, client, mongo_app, monkeypatch):
+        """测试在检查点之后中止，续跑完成的结果可以解压回原文件"""
+        payload = os.urandom(20000) + b'checkpoint ' * 5000
+        monkeypatch.setattr(mongo_app, 'CHECKPOINT_INTERVAL_LAYERS', 2)
+        task_id = self._compress_task(client, mongo_app, payload, 5)
+
+        def crash_at_layer_3(task_id, progress):
+            if progress == 60: raise SimulatedCrash()
+        with monkeypatch.context() as crashed:
+            # 真正的进程中止不会执行 finally 里的 discard_checkpoint
+            crashed.setattr(mongo_app, 'update_task_progress', crash_at_layer_3)
+            crashed.setattr(mongo_app, 'discard_checkpoint', lambda task_id: None)
+            with pytest.raises(SimulatedCrash):
+                mongo_app.compression_worker(str(task_id))
+        task = mongo_app.tasks_collection.find_one({'_id': task_id})
+        assert task['status'] == '處理中' and task['checkpoint']['layer'] == 2
+
+        self._stale(mongo_app, task_id)
+        mongo_app.executor.calls.clear()
+        mongo_app.resume_stale_tasks()
+        assert mongo_app.tasks_collection.find_one({'_id': task_id})['resume_count'] == 1
+        (fn, args, kwargs), = mongo_app.executor.calls
+        fn(*args, **kwargs)
+
+        task = mongo_app.tasks_collection.find_one({'_id': task_id})
+        assert task['status'] == '完成' and 'checkpoint' not in task
+        assert any('檢查點繼續' in log for log in task['logs'])
+        archive = os.path.join(mongo_app.UPLOAD_FOLDER, task['result_filename'])
+        mongo_app.storage.download_to(task['result_file_id'], archive)
+        decompress_id = mongo_app.tasks_collection.insert_one({'type': 'decompress', 'status': '處理中', 'params': {
+            'original_file': archive, 'expected_filename': 'payload.bin',
+            'password_list': mongo_app.parse_password_text(task['password_file_content']),
+            'layer_manifest': task['layer_manifest']
+        }}).inserted_id
+        mongo_app.decompression_worker(str(decompress_id))
+        result = mongo_app.tasks_collection.find_one({'_id': decompress_id})
+        assert result['status'] == '完成'
+        output = os.path.join(mongo_app.OUTPUT_FOLDER, 'roundtrip.bin')
+        mongo_app.storage.download_to(result['result_file_id'], output)
+        with open(output, 'rb') as f:
+            assert f.read() == payload
+
+    def test_resume_limit_marks_task_failed(self, mongo_app, tmp_path):
+        """测试续跑次数用尽后标记失败并清除检查点"""
+        task_id = mongo_app.tasks_collection.insert_one({'type': 'compress', 'status': '處理中', 'params': {},
+                                                         'resume_count': mongo_app.MAX_TASK_RESUMES}).inserted_id
+        artifact = tmp_path / 'layer.7z'
+        artifact.write_bytes(b'layer')
+        mongo_app.save_checkpoint(task_id, 1, str(artifact), 'table', None)
+        self._stale(mongo_app, task_id)
+        mongo_app.resume_stale_tasks()
+        task = mongo_app.tasks_collection.find_one({'_id': task_id})
+        assert task['status'] == '失敗' and 'checkpoint' not in task
+        assert mongo_app.storage.usage() == (0, 0)
+        assert mongo_app.executor.calls == []
+
+    def test_cancelled_task_is_not_resumed(self, mongo_app):
+        """测试续跑前已要求取消的任务直接标记为已取消"""
+        task_id = mongo_app.tasks_collection.insert_one({'type': 'compress', 'status': '處理中', 'params': {}}).inserted_id
+        self._stale(mongo_app, task_id, cancel_requested=True)
+        mongo_app.resume_stale_tasks()
+        assert mongo_app.tasks_collection.find_one({'_id': task_id})['status'] == '已取消'
+        assert mongo_app.executor.calls == []
+
+    def test_restarted_process_does_not_adopt_old_tasks(self, mongo_app, monkeypatch):
+        """测试容器重启后主机名与 PID 相同的新进程不会替旧进程的任务续心跳"""
+        first = mongo_app.worker_id()
+        assert mongo_app.worker_id() == first
+        task_id = mongo_app.tasks_collection.insert_one({'type': 'compress', 'status': '處理中', 'params': {}, 'owner': first}).inserted_id
+        self._stale(mongo_app, task_id)
+        monkeypatch.setattr(mongo_app, 'worker_token_pid', None)  # 模拟同一 PID 的新进程
+        restarted = mongo_app.worker_id()
+        assert restarted != first and restarted.rsplit(':', 1)[0] == first.rsplit(':', 1)[0]
+        mongo_app.refresh_task_heartbeats()
+        assert mongo_app.tasks_collection.find_one(mongo_app.stale_task_query())['_id'] == task_id
+
+    def test_live_task_is_not_claimed(self, mongo_app):
+        """测试心跳正常的任务不会被其他进程接手"""
+        from datetime import datetime
+        task_id = mongo_app.tasks_collection.insert_one({'type': 'compress', 'status': '處理中', 'params': {},
+                                                         'heartbeat_at': datetime.utcnow()}).inserted_id
+        mongo_app.resume_stale_tasks()
+        assert 'resume_count' not in mongo_app.tasks_collection.find_one({'_id': task_id})
+        assert mongo_app.executor.calls == []
+
+
+class TestProgressStream:
+    """进度串流端点测试"""
+
+    def test_progress_stream_invalid_id(self, client):
+        """测试无效任务 ID 的进度串流"""
+        response = client.get('/progress-stream/invalid_task_id')
+        assert response.status_code in [400, 404, 500]
+
+    def _events(self, chunks):
+        import json
+        for chunk in chunks:
+            if chunk.startswith(b'data: '):
+                yield json.loads(chunk[len(b'data: '):])
+
+    def test_stream_emits_events_and_closes_on_terminal_status(self, client, mongo_app, monkeypatch):
+        """测试串流推送进度变化，任务结束后自动关闭"""
+        monkeypatch.setattr(mongo_app, 'PROGRESS_STREAM_POLL_SECONDS', 0)
+        task_id = mongo_app.tasks_collection.insert_one({'status': '處理中', 'progress': 10, 'progress_text': '壓縮中'}).inserted_id
+        response = client.get(f'/progress-stream/{task_id}', buffered=False)
+        assert response.mimetype == 'text/event-stream'
+        chunks = iter(response.response)
+        assert next(chunks).startswith(b'retry: ')
+        events = self._events(chunks)
+        assert next(events)['progress'] == 10
+        mongo_app.tasks_collection.update_one({'_id': task_id}, {'$set': {'status': '完成', 'progress': 100}})
+        remaining = list(events)
+        assert remaining[-1] == {'status': '完成', 'progress': 100, 'progress_text': '壓縮中'}
+
+    def test_stream_closes_before_sync_worker_timeout(self, client, mongo_app, monkeypatch):
+        """测试同步 worker 下串流在上限时间内结束，交由客户端重连"""
+        monkeypatch.setattr(mongo_app, 'PROGRESS_STREAM_POLL_SECONDS', 0.01)
+        monkeypatch.setattr(mongo_app, 'PROGRESS_STREAM_SYNC_MAX_SECONDS', 0.1)
+        assert mongo_app.progress_stream_max_seconds() == 0.1
+        task_id = mongo_app.tasks_collection.insert_one({'status': '處理中', 'progress': 10}).inserted_id
+        response = client.get(f'/progress-stream/{task_id}', buffered=False)
+        assert len(list(self._events(response.response))) == 1
+
+
+LATENCY_SERVER_SCRIPT = r'''
+import asyncio
+
+async def handle(reader, writer):
+    # 每收到一个字节，延迟 50ms 后回一个字节，模拟远端 MongoDB 的一次往返
+    while await reader.read(1):
+        await asyncio.sleep(0.05)
+        writer.write(b'.'); await writer.drain()
+    writer.close()
+
+async def main():
+    server = await asyncio.start_server(handle, '127.0.0.1', 0, backlog=1024)
+    print(server.sockets[0].getsockname()[1], flush=True)
+    await server.serve_forever()
+
+asyncio.run(main())
+'''
+
+GEVENT_SERVER_SCRIPT = r'''
+import sys, socket, threading
+from gunicorn.app.base import BaseApplication
+
+LATENCY_ADDRESS = ('127.0.0.1', int(sys.argv[3]))
+client_threads = []
+
+
+def round_trip():
+    with socket.create_connection(LATENCY_ADDRESS) as conn:
+        conn.sendall(b'.'); conn.recv(1)
+
+
+class RemoteCollection:
+    # 每次操作前先经过一次有延迟的 socket 往返，像真正的远端数据库
+    def __init__(self, collection): self._collection = collection
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr): return attr
+        def call(*args, **kwargs):
+            round_trip()
+            return attr(*args, **kwargs)
+        return call
+
+
+class RemoteDatabase:
+    def __init__(self, database): self._database = database
+    def __getitem__(self, name): return RemoteCollection(self._database[name])
+    def __getattr__(self, name): return getattr(self._database, name)
+
+
+class GeventTestApp(BaseApplication):
+    def load_config(self):
+        self.cfg.set('worker_class', 'async_server.NativeThreadGeventWorker')
+        self.cfg.set('bind', sys.argv[1])
+        self.cfg.set('workers', 1)
+        self.cfg.set('worker_connections', 1000)
+
+    def load(self):
+        import mongomock, mongomock.store
+        from flask import jsonify
+        from gevent import monkey
+        import app as app_module
+        store = mongomock.store.ServerStore()
+
+        class StubClient:
+            def __init__(self):
+                client_threads.append(threading.current_thread().name)
+                self._client = mongomock.MongoClient(_store=store)
+                self.admin = self._client.admin
+            def __getitem__(self, name): return RemoteDatabase(self._client[name])
+
+        app_module.MONGO_URI = 'mongodb://stub'
+        app_module.connect_mongo = StubClient
+        app_module.create_storage = lambda database: app_module.LocalStorage(sys.argv[2])
+
+        @app_module.app.route('/_test/mongo-clients')
+        def mongo_clients():
+            return jsonify({'socket_patched': monkey.is_module_patched('socket'), 'threads': client_threads})
+        return app_module.app
+
+GeventTestApp().run()
+'''
+
+
+class TestAsyncServer:
+    """gevent 服务模式测试"""
+
+    STREAMS = 200
+
+    def _read_stream(self, base_url, task_id, started, results):
+        import http.client
+        import json
+        import time
+        from urllib.parse import urlparse
+        address = urlparse(base_url)
+        result = {'first_event': None, 'last': None}
+        try:
+            conn = http.client.HTTPConnection(address.hostname, address.port, timeout=60)
+            conn.request('GET', f'/progress-stream/{task_id}')
+            for line in conn.getresponse():
+                if not line.startswith(b'data: '): continue
+                if result['first_event'] is None: result['first_event'] = time.monotonic() - started
+                result['last'] = json.loads(line[len(b'data: '):])
+                if result['last']['status'] not in ('處理中', 'pending'): break
+            conn.close()
+        except Exception as e:
+            result['error'] = repr(e)
+        results.append(result)
+
+    def test_streams_stay_responsive_while_task_runs(self, tmp_path):
+        """测试 NativeThreadGeventWorker 下数据库有延迟时，大量进度串流仍同时得到响应，压缩任务照常完成"""
+        pytest.importorskip('gevent')
+        pytest.importorskip('mongomock')
+        import json
+        import socket
+        import subprocess
+        import threading
+        import time
+        import urllib.request
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        base_url = f'http://127.0.0.1:{port}/'
+        repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        (tmp_path / 'latency.py').write_text(LATENCY_SERVER_SCRIPT)
+        (tmp_path / 'serve.py').write_text(GEVENT_SERVER_SCRIPT)
+        latency = subprocess.Popen([sys.executable, str(tmp_path / 'latency.py')], stdout=subprocess.PIPE)
+        server = None
+        try:
+            latency_port = latency.stdout.readline().decode().strip()
+            server = subprocess.Popen([sys.executable, str(tmp_path / 'serve.py'), f'127.0.0.1:{port}',
+                                       str(tmp_path / 'results'), latency_port],
+                                      cwd=repo_root, env={**os.environ, 'PYTHONPATH': repo_root},
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            for _ in range(100):
+                try:
+                    urllib.request.urlopen(base_url + 'health', timeout=1)
+                    break
+                except OSError:
+                    assert server.poll() is None, server.stderr.read().decode(errors='replace')[-2000:]
+                    time.sleep(0.1)
+            payload = os.urandom(50000) + b'gevent ' * 20000
+            boundary = 'geventtestboundary'
+            body = (f'--{boundary}\r\nContent-Disposition: form-data; name="iterations"\r\n\r\n3\r\n'
+                    f'--{boundary}\r\nContent-Disposition: form-data; name="formats"\r\n\r\nzip,targz,7z\r\n'
+                    f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="payload.bin"\r\n'
+                    f'Content-Type: application/octet-stream\r\n\r\n').encode() + payload + f'\r\n--{boundary}--\r\n'.encode()
+            request = urllib.request.Request(base_url + 'compress', data=body, method='POST',
+                                             headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+            task_id = json.loads(urllib.request.urlopen(request, timeout=10).read())['task_id']
+
+            # 每条串流每秒查一次数据库；查询若阻塞事件循环，200 条串流的首个事件要排队约 20 秒
+            results = []; started = time.monotonic()
+            readers = [threading.Thread(target=self._read_stream, args=(base_url, task_id, started, results))
+                       for _ in range(self.STREAMS)]
+            for reader in readers: reader.start()
+            for reader in readers: reader.join(90)
+            assert len(results) == self.STREAMS and not [r for r in results if 'error' in r]
+            assert max(r['first_event'] for r in results) < 5
+            assert {r['last']['status'] for r in results} == {'完成'}
+
+            archive = urllib.request.urlopen(base_url + f'download/{task_id}', timeout=10).read()
+            assert archive[:6] == b'7z\xbc\xaf\x27\x1c'
+            # 事件循环、背景维护与 executor 线程各用各的 MongoClient，没有跨线程共用的连线
+            clients = json.loads(urllib.request.urlopen(base_url + '_test/mongo-clients', timeout=5).read())
+            assert clients['socket_patched']
+            assert len(clients['threads']) == len(set(clients['threads'])) >= 3
+            assert 'task-maintenance' in clients['threads']
+            assert any(name.startswith('ThreadPoolExecutor') for name in clients['threads'])
+        finally:
+            for process in (server, latency):
+                if process:
+                    process.terminate()
+                    process.wait(10)
+
+
+class TestQRCode:
+    """分享二维码测试"""
+
+    def test_png_with_etag_and_cache_headers(self, client):
+        """测试 PNG 输出带强 ETag 与 Cache-Control"""
+        response = client.get('/qrcode/507f1f77bcf86cd799439011')
+        assert response.status_code == 200
+        assert response.content_type == 'image/png'
+        assert response.data.startswith(b'\x89PNG')
+        assert response.headers['ETag'] and not response.headers['ETag'].startswith('W/')
+        assert 'public' in response.headers['Cache-Control']
+
+    def test_if_none_match_returns_304(self, client):
+        """测试相同 ETag 再次请求返回 304"""
+        first = client.get('/qrcode/507f1f77bcf86cd799439011?format=svg')
+        assert first.content_type.startswith('image/svg+xml')
+        second = client.get('/qrcode/507f1f77bcf86cd799439011?format=svg',
+                            headers={'If-None-Match': first.headers['ETag']})
+        assert second.status_code == 304
+
+    def test_cache_is_bounded(self, monkeypatch):
+        """测试缓存超过上限时淘汰最久未使用的项目"""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'QR_CACHE_SIZE', 2)
+        monkeypatch.setattr(app_module, 'qr_cache', app_module.OrderedDict())
+        for i in range(3):
+            app_module.get_qr_code(f'http://localhost/?share_id={i}', fmt='svg')
+        assert list(key[0] for key in app_module.qr_cache) == ['http://localhost/?share_id=1', 'http://localhost/?share_id=2']
+
+    def test_invalid_format_rejected(self, client):
+        """测试不支持的格式返回 400"""
+        response = client.get('/qrcode/507f1f77bcf86cd799439011?format=gif')
+        assert response.status_code == 400
+
+
 class TestFileDownload:
     """文件下载 API 测试"""
 
@@ -267,6 +845,326 @@ class TestSecurityFeatures:
         assert response.status_code in [400, 429, 500]
 
 
+class TestParallelGzip:
+    """平行 gzip 编解码测试"""
+
+    def test_multi_member_output_is_standard_gzip(self):
+        """测试多 member 输出可被标准 gzip 模块读取"""
+        import gzip
+        from app import ParallelGzipWriter
+        payload = os.urandom(5000) + b'layer' * 20000
+        buffer = BytesIO()
+        writer = ParallelGzipWriter(buffer, block_size=4096)
+        writer.write(payload)
+        writer.close()
+        assert writer.members > 1
+        assert gzip.decompress(buffer.getvalue()) == payload
+
+    def test_targz_layer_round_trip(self, tmp_path):
+        """测试 targz 层写入后可被 tarfile 与线程化读取器还原"""
+        import tarfile
+        from app import write_targz_layer, extract_targz_layer
+        source = tmp_path / 'data.bin'
+        source.write_bytes(b'0123456789' * 50000)
+        archive = tmp_path / 'layer.tar.gz'
+        write_targz_layer(str(source), str(archive))
+        with tarfile.open(archive, 'r:gz') as tf:
+            assert tf.extractfile('data.bin').read() == source.read_bytes()
+        extract_targz_layer(str(archive), str(tmp_path / 'out'))
+        assert (tmp_path / 'out' / 'data.bin').read_bytes() == source.read_bytes()
+
+    def test_threaded_reader_reads_across_chunks(self, tmp_path):
+        """测试任意长度的 read 跨越区块边界时内容正确"""
+        import gzip
+        from app import ThreadedGzipReader
+        payload = os.urandom(3000) * 7
+        archive = tmp_path / 'data.gz'
+        archive.write_bytes(gzip.compress(payload))
+        reader = ThreadedGzipReader(str(archive), chunk_size=1000)
+        try:
+            parts = [reader.read(size) for size in (1, 999, 1500, 7)]
+            parts.append(reader.read())
+            assert reader.read(10) == b''
+        finally:
+            reader.close()
+        assert b''.join(parts) == payload
+
+    def test_threaded_reader_rejects_non_gzip(self, tmp_path):
+        """测试非 gzip 内容会抛出 tarfile.ReadError"""
+        import tarfile
+        from app import extract_targz_layer
+        bogus = tmp_path / 'bogus.tar.gz'
+        bogus.write_bytes(b'not a gzip stream' * 10)
+        with pytest.raises(tarfile.ReadError):
+            extract_targz_layer(str(bogus), str(tmp_path / 'out'))
+
+
+class TestModernCodecs:
+    """zstd / LZ4 层格式测试"""
+
+    @pytest.mark.parametrize('writer_name, reader_name, suffix', [
+        ('write_tarzst_layer', 'extract_tarzst_layer', '.tar.zst'),
+        ('write_tarlz4_layer', 'extract_tarlz4_layer', '.tar.lz4'),
+    ])
+    def test_layer_round_trip(self, tmp_path, writer_name, reader_name, suffix):
+        """测试 tarzst / tarlz4 层写入后可还原"""
+        pytest.importorskip('zstandard' if suffix == '.tar.zst' else 'lz4')
+        import app
+        source = tmp_path / 'data.bin'
+        source.write_bytes(os.urandom(1000) + b'codec' * 20000)
+        archive = tmp_path / f'layer{suffix}'
+        getattr(app, writer_name)(str(source), str(archive))
+        getattr(app, reader_name)(str(archive), str(tmp_path / 'out'))
+        assert (tmp_path / 'out' / 'data.bin').read_bytes() == source.read_bytes()
+
+    def test_unknown_layer_format_rejected(self, client):
+        """测试未知的压缩格式会被拒绝"""
+        data = {
+            'file': (BytesIO(b'test' * 100), 'test.dat'),
+            'iterations': 2,
+            'formats': 'zip,rar'
+        }
+        response = client.post('/compress', data=data, content_type='multipart/form-data')
+        assert response.status_code in [400, 429, 500]
+
+    def test_fake_zstd_rejected(self, client):
+        """测试伪造的 zstd 文件被魔数检查拒绝"""
+        data = {
+            'file': (BytesIO(b'FAKE' + b'\x00' * 50), 'fake.tar.zst'),
+            'passwords': '第 1 層 (fake.tar.zst): (無密碼)'
+        }
+        response = client.post('/decompress-manual', data=data, content_type='multipart/form-data')
+        assert response.status_code in [400, 429, 500]
+
+    def test_password_table_with_new_formats(self):
+        """测试密码表可解析新格式的文件名"""
+        from app import parse_password_text
+        table = """第 1 層 (a_layer_1.tar.zst): (無密碼)
+第 2 層 (a_layer_2.tar.lz4): (特殊密碼層)"""
+        assert parse_password_text(table) == [
+            {'filename': 'a_layer_1.tar.zst', 'password': None},
+            {'filename': 'a_layer_2.tar.lz4', 'password': 'MASTER_PASSWORD_PLACEHOLDER'},
+        ]
+
+
+class TestAdaptiveCodec:
+    """自动压缩策略测试"""
+
+    def test_incompressible_data_is_stored(self, tmp_path):
+        """测试随机数据被判定为只封装"""
+        from app import choose_layer_strategy
+        sample = tmp_path / 'random.bin'
+        sample.write_bytes(os.urandom(300 * 1024))
+        strategy, ratio = choose_layer_strategy(str(sample))
+        assert strategy == 'store'
+        assert ratio >= 0.98
+
+    def test_compressible_data_uses_default_level(self, tmp_path):
+        """测试高重复数据使用标准压缩"""
+        from app import choose_layer_strategy
+        sample = tmp_path / 'text.txt'
+        sample.write_bytes(b'hello layer ' * 50000)
+        strategy, _ = choose_layer_strategy(str(sample))
+        assert strategy == 'default'
+
+    def test_lz4_layers_record_no_strategy(self, client, mongo_app):
+        """测试 tarlz4 层不套用也不记录自动策略"""
+        pytest.importorskip('lz4')
+        data = {'file': (BytesIO(os.urandom(50000)), 'random.bin'), 'iterations': '2',
+                'formats': 'targz,tarlz4', 'codec_mode': 'auto'}
+        response = client.post('/compress', data=data, content_type='multipart/form-data')
+        assert response.status_code == 200
+        (fn, args, kwargs), = mongo_app.executor.calls
+        fn(*args, **kwargs)
+        task = mongo_app.tasks_collection.find_one({'status': '完成'})
+        lines = task['password_file_content'].splitlines()
+        lz4_index = next(i for i, line in enumerate(lines) if line.startswith('第 2 層'))
+        assert '自動策略' in lines[lz4_index - 1]
+        assert '自動策略' not in lines[lz4_index + 1]
+        assert [layer.get('strategy') for layer in task['layer_manifest']['layers']] == ['store', None]
+
+    def test_strategy_lines_do_not_break_password_parsing(self):
+        """测试密码表中的策略行不会被解析成密码层"""
+        from app import parse_password_text
+        table = """--- 壓縮密碼表 ---
+第 1 層 (a_layer_1.zip): abc123
+    └ 自動策略: 標準壓縮 (取樣壓縮率 0.31)
+第 2 層 (a_layer_2.tar.gz): (無密碼)
+    └ 自動策略: 僅封裝 (取樣壓縮率 1.00)"""
+        assert parse_password_text(table) == [
+            {'filename': 'a_layer_1.zip', 'password': 'abc123'},
+            {'filename': 'a_layer_2.tar.gz', 'password': None},
+        ]
+
+
+class TestLayerManifest:
+    """逐层完整性清单测试"""
+
+    def _manifest(self, tmp_path):
+        from app import new_layer_manifest, add_manifest_layer
+        source = tmp_path / 'source.txt'
+        source.write_bytes(b'manifest ' * 1000)
+        layer = tmp_path / 'a_layer_1.zip'
+        layer.write_bytes(b'layer-bytes' * 100)
+        manifest = new_layer_manifest(str(source))
+        add_manifest_layer(manifest, 1, str(layer), 'abc123')
+        return manifest, layer
+
+    def test_manifest_round_trip_through_password_table(self, tmp_path):
+        """测试清单附在密码表后可被解析，且不影响密码解析"""
+        from app import render_layer_manifest, parse_layer_manifest, parse_password_text
+        manifest, _ = self._manifest(tmp_path)
+        table = "--- 壓縮密碼表 ---\n第 1 層 (a_layer_1.zip): abc123\n" + render_layer_manifest(manifest)
+        assert parse_layer_manifest(table) == manifest
+        assert parse_password_text(table) == [{'filename': 'a_layer_1.zip', 'password': 'abc123'}]
+        assert parse_layer_manifest("第 1 層 (a_layer_1.zip): abc123") is None
+
+    def test_wrong_password_rejected_before_extraction(self, tmp_path):
+        """测试密码打错时在解压前就报错"""
+        from app import verify_layer_passwords
+        manifest, _ = self._manifest(tmp_path)
+        verify_layer_passwords([{'filename': 'a_layer_1.zip', 'password': 'abc123'}], None, manifest)
+        with pytest.raises(ValueError):
+            verify_layer_passwords([{'filename': 'a_layer_1.zip', 'password': 'abc124'}], None, manifest)
+
+    def test_corrupted_layer_detected(self, tmp_path):
+        """测试文件内容被改动时校验失败"""
+        from app import verify_layer_file
+        manifest, layer = self._manifest(tmp_path)
+        verify_layer_file(str(layer), manifest['layers'][0], '第 1 層')
+        layer.write_bytes(b'layer-bytez' * 100)
+        with pytest.raises(ValueError):
+            verify_layer_file(str(layer), manifest['layers'][0], '第 1 層')
+
+    def test_share_route_checks_master_password_once(self, client, mongo_app, tmp_path, monkeypatch):
+        """测试分享路由只在未命中缓存时核对一次特殊密码"""
+        source = tmp_path / 'source.txt'
+        source.write_bytes(b'manifest ' * 100)
+        manifest = mongo_app.new_layer_manifest(str(source))
+        table = ''
+        for layer in range(1, 7):
+            path = tmp_path / f'a_layer_{layer}.7z'
+            path.write_bytes(b'layer %d' % layer)
+            password = None if layer % 2 == 0 else f'pass{layer}'
+            mongo_app.add_manifest_layer(manifest, layer, str(path), password)
+            table += f"第 {layer} 層 ({path.name}): {password or '(特殊密碼層)'}\n"
+        file_id = mongo_app.storage.put_file(str(path), path.name)
+        share_id = mongo_app.tasks_collection.insert_one({
+            'type': 'compress', 'status': '完成', 'result_file_id': file_id, 'result_filename': path.name,
+            'password_file_content': table + mongo_app.render_layer_manifest(manifest), 'layer_manifest': manifest,
+            'master_pass_verifier': mongo_app.master_password_verifier('master'),
+            'params': {'raw_filename': 'source.txt'}
+        }).inserted_id
+        calls = []
+        real_hash = mongo_app.password_hash
+        monkeypatch.setattr(mongo_app, 'password_hash', lambda password, salt: calls.append(password) or real_hash(password, salt))
+
+        assert client.post(f'/start-shared-decompression/{share_id}', json={'master_password': 'wrong'}).status_code == 400
+        assert calls == ['wrong']
+        calls.clear()
+        first = client.post(f'/start-shared-decompression/{share_id}', json={'master_password': 'master'})
+        assert first.status_code == 200 and calls == ['master']
+        calls.clear()
+        again = client.post(f'/start-shared-decompression/{share_id}', json={'master_password': 'master'}).get_json()
+        assert again['cached'] and calls == []
+
+    def test_master_password_check_not_exposed(self, client, mongo_app):
+        """测试特殊密码层不在清单中留下检查值，/status 也不返回特殊密码与验证值"""
+        data = {'file': (BytesIO(os.urandom(2000)), 'secret.bin'), 'iterations': '3', 'formats': '7z',
+                'use_master_pass': 'on', 'master_password': 'master', 'master_password_interval': '2'}
+        assert client.post('/compress', data=data, content_type='multipart/form-data').status_code == 200
+        (fn, args, kwargs), = mongo_app.executor.calls
+        fn(*args, **kwargs)
+        task = mongo_app.tasks_collection.find_one({'status': '完成'})
+        assert task['master_pass_verifier']['hash']
+        public = mongo_app.parse_layer_manifest(task['password_file_content'])
+        assert public['layers'][1]['pw_check'] is None
+        response = client.get(f"/status/{task['_id']}")
+        status = response.get_json()
+        assert status['layer_manifest']['layers'][1]['pw_check'] is None
+        assert 'master_pass_verifier' not in status and 'master_pass' not in status['params']
+        assert '"master"' not in response.get_data(as_text=True)
+
+    def test_malformed_manifest_rejected(self, client):
+        """测试损坏的清单返回 400"""
+        data = {
+            'file': (BytesIO(b'PK\x03\x04' + b'\x00' * 100), 'test.zip'),
+            'passwords': '第 1 層 (a_layer_1.zip): abc123\nMANIFEST: {not json'
+        }
+        response = client.post('/decompress-manual', data=data, content_type='multipart/form-data')
+        assert response.status_code in [400, 429, 500]
+
+
+class TestLocalStorage:
+    """本地结果存储测试"""
+
+    def test_put_download_and_delete(self, tmp_path):
+        """测试写入、读取、用量统计与删除"""
+        from app import LocalStorage
+        source = tmp_path / 'result.bin'
+        source.write_bytes(b'result' * 1000)
+        storage = LocalStorage(str(tmp_path / 'store'))
+        file_id = storage.put_file(str(source), 'result.bin')
+        assert storage.size(file_id) == 6000
+        assert storage.usage() == (6000, 1)
+        storage.download_to(file_id, str(tmp_path / 'copy.bin'))
+        assert (tmp_path / 'copy.bin').read_bytes() == source.read_bytes()
+        storage.delete(file_id)
+        assert storage.usage() == (0, 0)
+
+    def test_move_renames_instead_of_copying(self, tmp_path):
+        """测试 move=True 时同一文件系统直接改名，不再写第二份"""
+        from app import LocalStorage
+        source = tmp_path / 'result.bin'
+        source.write_bytes(b'result' * 1000)
+        inode = source.stat().st_ino
+        storage = LocalStorage(str(tmp_path / 'store'))
+        file_id = storage.put_file(str(source), 'result.bin', move=True)
+        assert not source.exists()
+        assert os.stat(storage._path(file_id)).st_ino == inode
+
+    def test_move_across_filesystems_copies(self, tmp_path, monkeypatch):
+        """测试跨文件系统时改为复制并删除来源"""
+        import errno
+        import app as app_module
+        real_replace = os.replace
+
+        def cross_device_replace(src, dst):
+            if not src.endswith('.part'): raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            real_replace(src, dst)
+        monkeypatch.setattr(app_module.os, 'replace', cross_device_replace)
+        source = tmp_path / 'result.bin'
+        source.write_bytes(b'result' * 1000)
+        storage = app_module.LocalStorage(str(tmp_path / 'store'))
+        file_id = storage.put_file(str(source), 'result.bin', move=True)
+        assert not source.exists()
+        assert storage.size(file_id) == 6000
+
+    def test_router_serves_ids_from_previous_backend(self, tmp_path):
+        """测试切换储存方式后，旧的 GridFS 文件 ID 仍可读取与删除"""
+        mongomock = pytest.importorskip('mongomock')
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+        from app import GridFSStorage, LocalStorage, StorageRouter
+        source = tmp_path / 'result.bin'
+        source.write_bytes(b'legacy' * 100)
+        gridfs = GridFSStorage(mongomock.MongoClient()['compressor_db'])
+        legacy_id = gridfs.put_file(str(source), 'result.bin')
+        storage = StorageRouter(LocalStorage(str(tmp_path / 'store')), gridfs)
+        new_id = storage.put_file(str(source), 'result.bin')
+        assert storage.size(legacy_id) == 600 and storage.size(new_id) == 600
+        assert storage.usage() == (1200, 2)
+        storage.delete(legacy_id)
+        assert storage.usage() == (600, 1)
+
+    def test_rejects_path_traversal_ids(self, tmp_path):
+        """测试非法文件 ID 不会被当作路径使用"""
+        from app import LocalStorage
+        storage = LocalStorage(str(tmp_path / 'store'))
+        with pytest.raises(ValueError):
+            storage.size('../../etc/passwd')
+
+
 class TestRateLimiting:
     """速率限制测试"""
 